@@ -0,0 +1,84 @@
+#!/usr/local/bin/python3.7
+"""
+Cache of calculated absorbance times, stored in the experiments database. Each entry is keyed on the
+experiment, the absorbed percentage and a fingerprint of the experiment's data, so an entry is
+ignored (and then replaced) as soon as the data it was calculated from changes.
+"""
+
+import hashlib
+import numpy as np
+from db import select_experiments
+
+
+def ensure_cache(conn):
+    conn.execute('''CREATE TABLE IF NOT EXISTS absorbance_cache (tens_exp_id INTEGER, percent_absorbed REAL,
+                    fingerprint TEXT, absorbance_time REAL, extrapolated INTEGER,
+                    PRIMARY KEY (tens_exp_id, percent_absorbed));''')
+    conn.commit()
+
+
+def exists(conn):
+    """
+    Whether the cache table exists (a read-only connection can't create it).
+    """
+    return conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'absorbance_cache';").fetchone() is not None
+
+
+def fingerprints(conn, tens_exp_ids):
+    """
+    Fingerprint the data of each experiment, without loading it into Python. Anything the absorbance time
+    depends on is included: the number of points, the last row, the sums of age and volume, and the
+    experiment's initial volume and frame rate.
+    """
+    c = conn.cursor()
+    select_experiments(c, tens_exp_ids)
+    c.execute('''SELECT tensiometer_data.tens_exp_id, count(*), max(tensiometer_data.rowid), total(age), total(vol),
+                 tensiometer_experiments.volume, tensiometer_experiments.fps
+                 FROM tensiometer_data JOIN selected_experiments USING (tens_exp_id)
+                 JOIN tensiometer_experiments USING (tens_exp_id)
+                 GROUP BY tensiometer_data.tens_exp_id;''')
+    return {row[0]: hashlib.sha1(repr(row[1:]).encode()).hexdigest() for row in c}
+
+
+def with_precision(fingerprints, dtype):
+    """
+    The fingerprints of times calculated from curves kept in the given precision. Single precision gives
+    slightly different times, so its entries never match a double precision run (the two replace each
+    other's entries instead); double precision keeps the plain fingerprints.
+    """
+    if np.dtype(dtype) == np.float64:
+        return fingerprints
+    return {i: fingerprint + '/' + np.dtype(dtype).name for i, fingerprint in fingerprints.items()}
+
+
+def lookup(conn, percent_absorbed, fingerprints):
+    """
+    Return {tens_exp_id: (absorbance_time, extrapolated)} for the experiments whose cache entry
+    matches their current fingerprint.
+    """
+    c = conn.cursor()
+    c.execute('SELECT tens_exp_id, fingerprint, absorbance_time, extrapolated FROM absorbance_cache WHERE percent_absorbed = ?;',
+              [percent_absorbed])
+    return {tens_exp_id: (absorbance_time, bool(extrapolated)) for tens_exp_id, fingerprint, absorbance_time, extrapolated in c
+            if fingerprints.get(tens_exp_id) == fingerprint}
+
+
+def store(conn, percent_absorbed, entries):
+    """
+    Save (tens_exp_id, fingerprint, absorbance_time, extrapolated) entries, replacing any stale ones.
+    """
+    conn.executemany('''INSERT OR REPLACE INTO absorbance_cache (tens_exp_id, percent_absorbed, fingerprint, absorbance_time, extrapolated)
+                        VALUES (?, ?, ?, ?, ?);''',
+                     [(tens_exp_id, percent_absorbed, fingerprint, float(absorbance_time), int(extrapolated))
+                      for tens_exp_id, fingerprint, absorbance_time, extrapolated in entries])
+    conn.commit()
+
+
+def purge(conn):
+    """
+    Empty the cache. Returns the number of entries removed.
+    """
+    ensure_cache(conn)
+    n = conn.execute('DELETE FROM absorbance_cache;').rowcount
+    conn.commit()
+    return n
@@ -0,0 +1,206 @@
+#!/usr/local/bin/python3.7
+"""
+Benchmark the pipeline on synthetic databases of several sizes: importing, loading the experiments,
+calculating absorbance times, grouping and headless rendering. Results are saved as JSON, and can be
+compared against a previous run to spot regressions. The startup stage checks the import time of the
+compute modules against a budget, and fails if any of them loads the plotting or scipy modules.
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+
+import numpy as np
+
+import synthetic_db
+import importer
+import calc_absorbance
+import db
+
+
+# Import-time budgets (s) for the modules the compute scripts start from, checked by the startup stage.
+# None of them should pull in the plotting or scipy modules, which are only needed for figures and fits.
+STARTUP_BUDGETS = {'calc_absorbance': 0.4, 'importer': 0.15, 'curve_cache': 0.4}
+HEAVY_MODULES = ('matplotlib', 'scipy', 'colorhash')
+
+
+def timed(function, repeat=3):
+    """
+    Best wall time of repeat calls, and the result of the last one.
+    """
+    best = float('inf')
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def bench_import(directory, n_experiments, fps, seed):
+    """
+    Import n_experiments synthetic experiment files into an empty database.
+    """
+    rng = np.random.default_rng(seed)
+    files = []
+    for i in range(n_experiments):
+        filename = os.path.join(directory, 'experiment-{}.txt'.format(i))
+        synthetic_db.write_experiment_file(filename, synthetic_db.curve(rng, fps))
+        files.append(filename)
+
+    conn = synthetic_db.create_database(os.path.join(directory, 'import.sqlite'), 0, fps, seed, with_data=False)
+    n_binders = conn.execute('SELECT count(*) FROM binders;').fetchone()[0]
+    start = time.perf_counter()
+    rows = 0
+    for i, filename in enumerate(files):
+        experimentID, n_rows, elapsed = importer.import_experiment(conn, filename, i % n_binders + 1, '2021-06-01', 4.0, fps)
+        rows += n_rows
+    seconds = time.perf_counter() - start
+    conn.close()
+    return seconds, rows
+
+
+def bench_render(experiments):
+    import plot
+    plot.show_figures = False
+    plot.plt.switch_backend('Agg')
+    plot.set_experiments(experiments)
+    jobs = [job for job in plot.figure_jobs() if job[1] == 'plotAbsorptionProfiles']
+    if len(experiments) >= 32: # the box plots need every group to be populated
+        jobs += [job for job in plot.figure_jobs() if job[1] == 'mainEffectsPlot' and job[3]['boxes']][:1]
+    with tempfile.TemporaryDirectory() as outdir:
+        return timed(lambda: [plot.render_job(job, outdir) for job in jobs], repeat=1)[0]
+
+
+def bench_startup(module, repeat=3):
+    """
+    Best import time of a module in a fresh interpreter (as reported by -X importtime), and the heavy
+    modules it loaded.
+    """
+    code = 'import sys, {}; print(" ".join(m for m in {!r} if m in sys.modules))'.format(module, HEAVY_MODULES)
+    best = float('inf')
+    for i in range(repeat):
+        p = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                           universal_newlines=True, cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
+        for line in p.stderr.splitlines():
+            fields = line.split('|')
+            if len(fields) == 3 and fields[2].strip() == module:
+                best = min(best, int(fields[1]) / 1e6)
+        heavy = p.stdout.split()
+    return best, heavy
+
+
+def startup(repeat):
+    """
+    Check the import time of each compute module against its budget. Returns the results and the number of failures.
+    """
+    results = []
+    failures = 0
+    for module, budget in STARTUP_BUDGETS.items():
+        seconds, heavy = bench_startup(module, repeat)
+        ok = seconds <= budget and not heavy
+        failures += not ok
+        results.append(dict(stage='startup', module=module, n_experiments=0, fps=0, seconds=seconds, budget=budget, heavy_modules=heavy))
+        print("{:>10} {:>16}: {:.3f} s (budget {:.3f} s){}{}".format('startup', module, seconds, budget,
+              ', loads ' + ', '.join(heavy) if heavy else '', '' if ok else ' <-- over budget'), file=sys.stderr)
+    return results, failures
+
+
+def run(n_experiments, fps, seed, stages, repeat):
+    results = []
+
+    def record(stage, seconds, **extra):
+        results.append(dict(stage=stage, n_experiments=n_experiments, fps=fps, seconds=seconds, **extra))
+        print("{:>10} {:>6} experiments @ {:g} fps: {:.3f} s".format(stage, n_experiments, fps, seconds), file=sys.stderr)
+
+    with tempfile.TemporaryDirectory() as directory:
+        if 'import' in stages:
+            seconds, rows = bench_import(directory, n_experiments, fps, seed)
+            record('import', seconds, rows=rows, rows_per_second=rows / seconds)
+
+        database_file = os.path.join(directory, 'data.sqlite')
+        conn = synthetic_db.create_database(database_file, n_experiments, fps, seed)
+        db.ensure_indexes(conn)
+        ids = [row[0] for row in conn.execute('SELECT tens_exp_id FROM tensiometer_experiments ORDER BY tens_exp_id;')]
+
+        seconds, experiments = timed(lambda: calc_absorbance.load_experiments(ids, conn), repeat)
+        if 'load' in stages:
+            record('load', seconds, rows=sum(len(e.x) for e in experiments),
+                   bytes_per_experiment=calc_absorbance.memory_usage(experiments)['bytes_per_experiment'])
+
+        if 'absorbance' in stages:
+            seconds, times = timed(lambda: [e.calc_absorbance_time(79) for e in experiments], repeat)
+            record('absorbance', seconds)
+        else:
+            for e in experiments:
+                e.calc_absorbance_time(79)
+
+        if 'grouping' in stages:
+            from grouping import GroupIndex
+            levels = [([['low-u'], ['high-u']], [['40k', '10k'], ['360k', '124k']]), ([['pva'], ['pvp']], [['low-y'], ['high-y']])]
+            seconds, groups = timed(lambda: [GroupIndex(experiments).split(x, s) for x, s in levels], repeat)
+            record('grouping', seconds)
+
+        if 'render' in stages:
+            record('render', bench_render(experiments))
+        conn.close()
+    return results
+
+
+def compare(results, baseline_file, threshold=1.2):
+    """
+    Print the ratio of each timing to the baseline run, flagging the ones that got slower than threshold.
+    """
+    with open(baseline_file) as f:
+        baseline = {(r['stage'], r['n_experiments'], r['fps'], r.get('module')): r['seconds'] for r in json.load(f)['results']}
+    regressions = 0
+    for r in results:
+        key = (r['stage'], r['n_experiments'], r['fps'], r.get('module'))
+        if key not in baseline:
+            continue
+        ratio = r['seconds'] / baseline[key]
+        flag = ' <-- slower' if ratio > threshold else ''
+        regressions += ratio > threshold
+        if key[3]:
+            print("{:>10} {:>16}: {:.2f}x baseline{}".format(key[0], key[3], ratio, flag))
+        else:
+            print("{:>10} {:>6} @ {:g} fps: {:.2f}x baseline{}".format(key[0], key[1], key[2], ratio, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--scales', default='10,100', help='comma-separated numbers of experiments')
+    parser.add_argument('--fps', default='100', help='comma-separated frame rates')
+    parser.add_argument('--stages', default='startup,import,load,absorbance,grouping,render')
+    parser.add_argument('--repeat', type=int, default=3, help='repetitions of each timing (the best is kept)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json', help='where to save the results')
+    parser.add_argument('--compare', metavar='BASELINE.json', help='compare against a previous run')
+    args = parser.parse_args()
+
+    stages = args.stages.split(',')
+    results = []
+    startup_failures = 0
+    if 'startup' in stages:
+        results, startup_failures = startup(args.repeat)
+    if set(stages) - {'startup'}:
+        for fps in [float(f) for f in args.fps.split(',')]:
+            for n in [int(n) for n in args.scales.split(',')]:
+                results.extend(run(n, fps, args.seed, stages, args.repeat))
+
+    with open(args.output, 'w') as f:
+        json.dump({'python': platform.python_version(), 'numpy': np.__version__, 'machine': platform.machine(),
+                   'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'results': results}, f, indent=1)
+
+    if startup_failures or (args.compare and compare(results, args.compare)):
+        sys.exit(1)
+
+
+# Main body
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,90 @@
+#!/usr/local/bin/python3.7
+"""
+Bootstrap confidence intervals for the absorbance time of each experiment, from the noise in the
+volume readings near the target.
+
+The noise level of each curve is estimated from the differences between successive readings. The points
+around the target are then perturbed with that noise thousands of times at once (one row per replicate)
+and the log-time interpolation is redone on every row. Only the window of points whose perturbed
+volume could plausibly reach the target is resampled; points further away can't change the result.
+Experiments run in parallel, each with its own random stream spawned from one seed, so the results
+don't depend on the number of workers.
+"""
+
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# Points within this many noise standard deviations of the target are perturbed
+WINDOW_SIGMAS = 6
+MIN_WINDOW = 8
+
+
+def noise_level(vol):
+    """
+    Robust estimate of the reading noise: the MAD of successive differences, scaled to a standard deviation.
+    """
+    if len(vol) < 3:
+        return 0.0
+    return float(np.median(np.abs(np.diff(vol))) / 0.6745 / np.sqrt(2))
+
+
+def window(sorted_vol, sorted_log_time, target, sigma):
+    """
+    The points of a volume-sorted curve that surround the target closely enough to matter.
+    """
+    near = np.count_nonzero(np.abs(sorted_vol - target) < WINDOW_SIGMAS * sigma)
+    half = max(near, MIN_WINDOW)
+    centre = np.searchsorted(sorted_vol, target)
+    lo = max(centre - half, 0)
+    hi = min(centre + half, len(sorted_vol))
+    return sorted_vol[lo:hi], sorted_log_time[lo:hi]
+
+
+def resample(vol, log_time, target, sigma, n, rng):
+    """
+    Absorbance times for n perturbed copies of the curve window, interpolated (or extrapolated from the
+    end segments) like calc_absorbance.log_interp, but for all the copies at once.
+    """
+    perturbed = vol + rng.normal(0, sigma, (n, len(vol)))
+    order = np.argsort(perturbed, axis=1, kind='mergesort')
+    v = np.take_along_axis(perturbed, order, axis=1)
+    t = log_time[order]
+    hi = np.count_nonzero(v < target, axis=1).clip(1, len(vol) - 1)[:, None]
+    lo = hi - 1
+    v_lo, v_hi = np.take_along_axis(v, lo, axis=1), np.take_along_axis(v, hi, axis=1)
+    t_lo, t_hi = np.take_along_axis(t, lo, axis=1), np.take_along_axis(t, hi, axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_abs_time = (t_hi - t_lo) / (v_hi - v_lo) * (target - v_lo) + t_lo
+    return np.exp(log_abs_time[:, 0])
+
+
+def _bootstrap_one(task):
+    vol, log_time, target, sigma, n, seed, confidence = task
+    if sigma == 0 or len(vol) < 2:
+        return np.nan, np.nan, np.nan
+    times = resample(vol, log_time, target, sigma, n, np.random.default_rng(seed))
+    times = times[np.isfinite(times)]
+    if len(times) == 0:
+        return np.nan, np.nan, np.nan
+    # percentiles rather than a standard deviation, since extrapolated times are very heavy-tailed
+    tail = (100 - confidence) / 2
+    median, low, high = np.percentile(times, [50, tail, 100 - tail])
+    return float(median), float(low), float(high)
+
+
+def bootstrap(experiments, percent_absorbed, n=2000, seed=0, confidence=95, workers=None):
+    """
+    Bootstrap the absorbance time of each experiment. Returns {tens_exp_id: (median, ci_low, ci_high)}.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(len(experiments))
+    tasks = []
+    for e, s in zip(experiments, seeds):
+        sorted_vol, sorted_log_time = e.interpolation_curve()
+        target = e.target_volume(percent_absorbed)
+        # the same points as the interpolation uses, but in time order, for the successive differences
+        sigma = noise_level(e.y[(e.x > 0) & (e.y > 0)])
+        vol, log_time = window(sorted_vol, sorted_log_time, target, sigma)
+        tasks.append((vol, log_time, target, sigma, n, s, confidence))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(_bootstrap_one, tasks, chunksize=max(len(tasks) // (4 * (workers or 4)), 1)))
+    return {e.experiment['tens_exp_id']: r for e, r in zip(experiments, results)}
@@ -7,81 +7,503 @@ for all tensiometer experiments in the database.
 
 import sys
 import os
-import sqlite3
-from scipy import interpolate
-from math import log
+import mmap
+import pickle
+import weakref
+from functools import lru_cache
+from collections.abc import Mapping
+import argparse
+from itertools import groupby
+from operator import itemgetter
+import numpy as np
 from math import exp
-import matplotlib
-import matplotlib.pyplot as plt
-from colorhash import ColorHash
-from exclude import exclusions
+import filters
+from db import select_experiments, connect, pool
+import absorbance_cache
+import summary
+import profiling
+import export
+
+def log_interp(vol, log_time, target_volumes):
+    """
+    Linear interpolation of log(time) against volume, extrapolating linearly from the end segments
+    when a target lies outside the measured range. vol must be sorted (ascending) with log_time in the
+    same order. This is the same calculation as scipy's interp1d(..., fill_value='extrapolate'),
+    but vectorized over all the targets and without building an interpolator each time.
+    """
+    target_volumes = np.asarray(target_volumes, dtype=np.float64)
+    hi = np.searchsorted(vol, target_volumes).clip(1, len(vol) - 1)
+    lo = hi - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = (log_time[hi] - log_time[lo]) / (vol[hi] - vol[lo])
+    return slope * (target_volumes - vol[lo]) + log_time[lo]
+
+
+# The curve attributes of an Experiment, which a lazily-built Experiment loads on first access
+CURVE_ATTRIBUTES = ('x', 'y', '_usable_ends', '_sorted_vol', '_sorted_log_time')
+
+# Precision the curves are kept in by default. float32 (--float32) halves their memory, and its ~7
+# significant digits are more than the tensiometer measures.
+CURVE_DTYPE = np.float64
+
+# Number of experiments whose curves a CurveLoader reads in one query
+CURVE_BATCH_SIZE = 64
+
+
+def curve_from_rows(data, fps):
+    """
+    The curve (time in s, volume) of an experiment from its tensiometer_data rows
+    (tens_exp_id, age, ca_left, ca_avg, ca_right, height, bd, vol).
+    """
+    age, ca_left, ca_avg, ca_right, height, bd, vol = 1, 2, 3, 4, 5, 6, 7
+    data = np.array(data, dtype=np.float64)
+    return ((data[:, age] - data[0, age])/1000)/fps, data[:, vol]
+
+
+def _owned_bytes(a):
+    """
+    Bytes of an array's data that this process holds, i.e. not counting views into a memory map.
+    """
+    base = a
+    while base is not None:
+        if isinstance(base, (np.memmap, mmap.mmap)):
+            return 0
+        base = base.base if isinstance(base, np.ndarray) else None
+    return a.nbytes
+
+
+class Record(Mapping):
+    """
+    A database row, read like a (read-only) dict of column name -> value, but stored compactly: the values
+    are a tuple, and the column names are held once per table, by the columns() all its rows share.
+    """
+    __slots__ = ('_columns', '_values', '__weakref__')
+
+    def __init__(self, names, values):
+        self._columns = columns(names)
+        self._values = tuple(values)
+
+    def __getitem__(self, key):
+        return self._values[self._columns[1][key]]
+
+    def __iter__(self):
+        return iter(self._columns[0])
+
+    def __len__(self):
+        return len(self._values)
+
+    def __repr__(self):
+        return 'Record({!r})'.format(dict(self.items()))
+
+    def __reduce__(self):
+        return make_record, (self._columns[0], self._values)
+
+    def memory_usage(self):
+        """
+        Bytes held by the record and its values (interned strings included, although they're shared).
+        """
+        return sys.getsizeof(self) + sys.getsizeof(self._values) + sum(sys.getsizeof(value) for value in self._values)
+
+
+@lru_cache(maxsize=32)
+def columns(names):
+    """
+    The column names of a table and their positions, shared by its Records.
+    """
+    names = tuple(names)
+    return names, {n: i for i, n in enumerate(names)}
+
+
+# (column names, values) -> Record, for the rows that are shared; entries go once no experiment uses them
+_interned = weakref.WeakValueDictionary()
+
+def make_record(names, values, intern=False):
+    """
+    The Record for a row, with its strings interned. With intern, equal rows share one Record, e.g. a
+    binder row loaded again by another query.
+    """
+    names = tuple(names)
+    record = Record(names, (sys.intern(v) if isinstance(v, str) else v for v in values))
+    if intern:
+        record = _interned.setdefault((names, record._values), record)
+    return record
+
 
 class Experiment():
-    absorbance_time = -1
-
-    def __init__(self, data, experiment, binder):
-        age, ca_left, ca_avg, ca_right, height, bd, vol = 1, 2, 3, 4, 5, 6, 7
-        initial_time = data[0][age]
-        x = [ ((e[age] - initial_time)/1000)/experiment['fps'] for e in data ]
-        y = [ e[vol] for e in data ] 
-        self.x = x
-        self.y = y
-        self.binder = binder
+    # slots rather than a __dict__ per instance, since thousands of experiments are held at once
+    __slots__ = ('experiment', 'binder', 'absorbance_time', 'extrapolated', '_loader') + CURVE_ATTRIBUTES
+
+    def __init__(self, data, experiment, binder, dtype=CURVE_DTYPE):
+        self._set_metadata(experiment, binder)
+        self.set_curve(*curve_from_rows(data, experiment['fps']), dtype=dtype)
+
+    def _set_metadata(self, experiment, binder, loader=None):
         self.experiment = experiment
+        self.binder = binder
+        self.absorbance_time = -1
+        self.extrapolated = False
+        self._loader = loader
+
+    @classmethod
+    def from_curve(cls, x, y, experiment, binder, dtype=CURVE_DTYPE):
+        """
+        Build an Experiment from an already-calculated curve (time in s, volume), e.g. views into the curve cache.
+        """
+        e = cls.__new__(cls)
+        e._set_metadata(experiment, binder)
+        e.set_curve(x, y, dtype)
+        return e
+
+    @classmethod
+    def from_metadata(cls, experiment, binder, loader):
+        """
+        Build an Experiment without its curve, which the loader reads the first time it is needed.
+        """
+        e = cls.__new__(cls)
+        e._set_metadata(experiment, binder, loader)
+        loader.add(e)
+        return e
+
+    def __getattr__(self, name):
+        # only called for unset slots, i.e. the curve of a lazily-built experiment that isn't loaded yet
+        if name in CURVE_ATTRIBUTES and self._loader is not None:
+            self._loader.load(self)
+            return object.__getattribute__(self, name)
+        raise AttributeError(name)
+
+    def _is_set(self, name):
+        # without going through __getattr__, which would load the curve
+        try:
+            object.__getattribute__(self, name)
+            return True
+        except AttributeError:
+            return False
+
+    def __getstate__(self):
+        # a lazily-built experiment is pickled without its curve, which is read again where it's needed
+        names = self.__slots__ if self._loader is None else self.__slots__[:-len(CURVE_ATTRIBUTES)]
+        return {name: object.__getattribute__(self, name) for name in names if self._is_set(name)}
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+        # queue up with the (unpickled) loader again, so the curves are still read in batches
+        if self._loader is not None:
+            self._loader.add(self)
+
+    def curve_loaded(self):
+        return self._is_set('x')
+
+    def release_curve(self):
+        """
+        Drop the curve of a lazily-built experiment to free its memory; it is loaded again if it's used.
+        """
+        if self._loader is None or not self.curve_loaded():
+            return
+        for name in CURVE_ATTRIBUTES:
+            if self._is_set(name):
+                delattr(self, name)
+
+    def memory_usage(self):
+        """
+        Bytes held by this experiment, as (metadata, curve). The binder record is shared with the other
+        experiments of the binder, so it isn't counted here; neither are curves mapped from the curve cache.
+        """
+        metadata = sys.getsizeof(self) + self.experiment.memory_usage()
+        curve = 0
+        if self.curve_loaded():
+            curve = sum(_owned_bytes(object.__getattribute__(self, name)) for name in CURVE_ATTRIBUTES if name != '_usable_ends')
+            curve += sys.getsizeof(self._usable_ends)
+        return metadata, curve
+
+    def set_curve(self, x, y, dtype=CURVE_DTYPE):
+        """
+        Store the curve (time in s, volume) in the given precision and prepare it for interpolation: only the
+        points with a positive time and volume are used, with time on a log scale (better extrapolation),
+        sorted by volume.
+        """
+        self.x = np.ascontiguousarray(x, dtype=dtype)
+        self.y = np.ascontiguousarray(y, dtype=dtype)
+        positive = (self.x > 0) & (self.y > 0)
+        vol = self.y[positive]
+        # the first and last usable volumes decide whether a target needs extrapolating
+        self._usable_ends = (float(vol[0]), float(vol[-1])) if len(vol) else (np.nan, np.nan)
+        log_time = np.log(self.x[positive])
+        order = np.argsort(vol, kind='mergesort')
+        self._sorted_vol = vol[order]
+        self._sorted_log_time = log_time[order]
     
-    def calc_absorbance_time(self, target_volume):
+    def interpolation_curve(self):
+        """
+        The (volume, log time) points used for interpolation, sorted by volume.
+        """
+        return self._sorted_vol, self._sorted_log_time
+
+    def target_volume(self, percent_absorbed):
+        return ((100 - percent_absorbed) / 100) * self.experiment['volume']
+
+    def calc_absorbance_time(self, percent_absorbed):
+        target_volume = self.target_volume(percent_absorbed)
         #print(self.experiment['fps'], self.experiment['volume'], target_volume)
-        target_volume = ((100 - target_volume)  / 100) * self.experiment['volume']
-        pairs = [ (e[0], e[1]) for e in zip(self.x, self.y) if e[0] > 0 and e[1] > 0]
-        x = [ log(e[0]) for e in pairs] # better extrapolation when time is on log scale
-        y = [ e[1] for e in pairs]
+        first, last = self._usable_ends
         # Interpolation, if possible, else, extrapolation
-        if (y[-1] > target_volume or y[0] < target_volume):
-            print("Warning, extrapolating! Target is {}, max is {}, min is {}".format(target_volume, y[0], y[-1]), file=sys.stderr)
-        interpolater = interpolate.interp1d(y, x, fill_value='extrapolate')
-        abs_time = exp( interpolater(target_volume) ) # remember, x = log(time)
+        self.extrapolated = bool(last > target_volume or first < target_volume)
+        if self.extrapolated:
+            print("Warning, extrapolating! Target is {}, max is {}, min is {}".format(target_volume, first, last), file=sys.stderr)
+        abs_time = exp( log_interp(self._sorted_vol, self._sorted_log_time, target_volume) ) # remember, x = log(time)
         #print("Absorbance time at given percentage is", abs_time, file=sys.stderr)
         self.absorbance_time = abs_time
         return abs_time
 
+    def calc_absorbance_times(self, percents_absorbed):
+        """
+        Absorbance times for several absorbed percentages at once, with a single interpolation call.
+        """
+        targets = ((100 - np.asarray(percents_absorbed, dtype=np.float64)) / 100) * self.experiment['volume']
+        first, last = self._usable_ends
+        outside = (last > targets) | (first < targets)
+        if outside.any():
+            print("Warning, extrapolating for experiment {}! Targets {}, max is {}, min is {}".format(self.experiment['tens_exp_id'],
+                  ', '.join(str(t) for t in targets[outside]), first, last), file=sys.stderr)
+        return np.exp( log_interp(self._sorted_vol, self._sorted_log_time, targets) )
+
+
+def memory_usage(experiments):
+    """
+    Memory held by a list of experiments, in bytes: the metadata and curves of each (see
+    Experiment.memory_usage) and, counted once, the binder records they share.
+    """
+    usage = [e.memory_usage() for e in experiments]
+    binders = {id(e.binder): e.binder for e in experiments if e.binder is not None}
+    metadata, curves = sum(u[0] for u in usage), sum(u[1] for u in usage)
+    shared = sum(b.memory_usage() for b in binders.values())
+    return dict(count=len(usage), metadata_bytes=metadata, curve_bytes=curves, shared_bytes=shared,
+                bytes_per_experiment=(metadata + curves + shared) / len(usage) if usage else None)
+
+
+def load_experiments(tens_exp_ids, conn):
+    """
+    Load all the given experiments at once: one query for the experiment rows, one for the binders and
+    one ordered query for all of the curve data, which is then split up in memory.
+    Returns the Experiments in the same order as tens_exp_ids.
+    """
+    experiments, binders = load_metadata(tens_exp_ids, conn)
+    loaded = {}
+    for tens_exp_id, (x, y) in load_curves(tens_exp_ids, conn, experiments).items():
+        experiment = experiments[tens_exp_id]
+        loaded[tens_exp_id] = Experiment.from_curve(x, y, experiment, binders.get(experiment['binder']))
+
+    missing = [i for i in tens_exp_ids if i not in loaded]
+    if missing:
+        print("Warning, no data for experiment(s) {}".format(', '.join(str(i) for i in missing)), file=sys.stderr)
+    return [loaded[i] for i in tens_exp_ids if i in loaded]
+
+
+def load_curves(tens_exp_ids, conn, experiments):
+    """
+    Read the curves of the given experiments with one ordered query, as {tens_exp_id: (x, y)}.
+    experiments is {tens_exp_id: experiment row}, for the frame rates. Experiments without data are left out.
+    The ids go in a temporary table of their own, so a lazy load doesn't replace the selected_experiments
+    that load_metadata leaves behind.
+    """
+    c = conn.cursor()
+    select_experiments(c, tens_exp_ids, table='selected_curves')
+    # driven from the selected ids (CROSS JOIN fixes the join order), so a small batch only visits its own rows
+    c.execute('''SELECT tensiometer_data.tens_exp_id, age, ca_left, ca_avg, ca_right, height, bd, vol
+                 FROM selected_curves CROSS JOIN tensiometer_data ON tensiometer_data.tens_exp_id = selected_curves.tens_exp_id
+                 ORDER BY selected_curves.tens_exp_id, tensiometer_data.rowid;''')
+    return {tens_exp_id: curve_from_rows(list(data), experiments[tens_exp_id]['fps'])
+            for tens_exp_id, data in groupby(c, key=itemgetter(0))}
+
+
+def lazy_experiments(tens_exp_ids, conn, batch_size=CURVE_BATCH_SIZE, dtype=CURVE_DTYPE):
+    """
+    Like load_experiments, but only the metadata is read now: each curve is read the first time it is
+    used, together with the curves of the next batch_size - 1 experiments that haven't been loaded yet.
+    Filtering on the metadata beforehand means only the curves actually used are ever read. The curves
+    are kept in the given precision, wherever they're loaded.
+    """
+    experiments, binders = load_metadata(tens_exp_ids, conn)
+    with_data = summary.with_data(conn, tens_exp_ids)
+    missing = [i for i in tens_exp_ids if i not in with_data]
+    if missing:
+        print("Warning, no data for experiment(s) {}".format(', '.join(str(i) for i in missing)), file=sys.stderr)
+    loader = CurveLoader(conn, batch_size, dtype)
+    return [Experiment.from_metadata(experiments[i], binders.get(experiments[i]['binder']), loader)
+            for i in tens_exp_ids if i in with_data]
+
+
+class CurveLoader():
+    """
+    Reads the curves of lazily-built Experiments from the database, a batch at a time, in the order the
+    experiments were added. When pickled (e.g. to send experiments to worker processes) the connection
+    is replaced by the database filename, and the loaders in the receiving process share its pool of
+    read-only connections.
+    """
+
+    def __init__(self, conn, batch_size=CURVE_BATCH_SIZE, dtype=CURVE_DTYPE):
+        self.conn = conn
+        # looked up now rather than when pickling, which may happen on another thread than the connection's
+        self.database_file = conn.execute('PRAGMA database_list;').fetchone()[2] if conn is not None else None
+        self.batch_size = batch_size
+        self.dtype = dtype # travels with the loader, so worker processes load in the same precision
+        self.pending = {} # tens_exp_id -> Experiment, in the order they were added
+
+    def add(self, experiment):
+        self.pending[experiment.experiment['tens_exp_id']] = experiment
+
+    def fetch(self, experiments):
+        """
+        The curves of the given experiments, as {tens_exp_id: (x, y)}.
+        """
+        metadata = {i: e.experiment for i, e in experiments.items()}
+        if self.conn is None:
+            with pool(self.database_file).connection() as conn:
+                return load_curves(list(experiments), conn, metadata)
+        return load_curves(list(experiments), self.conn, metadata)
+
+    def load(self, experiment):
+        tens_exp_id = experiment.experiment['tens_exp_id']
+        self.pending.pop(tens_exp_id, None)
+        batch = {tens_exp_id: experiment}
+        for i in list(self.pending)[:self.batch_size - 1]:
+            batch[i] = self.pending.pop(i)
+        curves = self.fetch(batch)
+        for i, e in batch.items():
+            e.set_curve(*curves.get(i, (np.empty(0), np.empty(0))), dtype=self.dtype)
+
+    def __getstate__(self):
+        # the pending experiments add themselves back as they're unpickled (see Experiment.__setstate__),
+        # so only the ones actually sent are queued in the receiving process
+        state = dict(self.__dict__, pending={})
+        if self.conn is not None:
+            state['conn'] = None
+            if not self.database_file:
+                raise pickle.PicklingError("Can't send experiments loaded from an in-memory database (a snapshot) to another process")
+        return state
+
+
+def load_metadata(tens_exp_ids, conn):
+    """
+    Load the experiment and binder rows for the given experiments, as {tens_exp_id: experiment} and
+    {binder_id: binder} dicts of Records (the binders are shared between loads). The ids are left in the selected_experiments table.
+    """
+    c = conn.cursor()
+    select_experiments(c, tens_exp_ids)
+
+    c.execute('''SELECT tensiometer_experiments.* FROM tensiometer_experiments
+                 JOIN selected_experiments USING (tens_exp_id);''')
+    names = [description[0] for description in c.description]
+    experiments = {row[0]: make_record(names, row) for row in c.fetchall()}
+
+    c.execute('''SELECT * FROM binders WHERE binder_id IN
+                 (SELECT binder FROM tensiometer_experiments JOIN selected_experiments USING (tens_exp_id));''')
+    names = [description[0] for description in c.description]
+    binders = {row[0]: make_record(names, row, intern=True) for row in c.fetchall()}
+    return experiments, binders
 
 
 def getExperiment(tens_exp_id, cursor):
-    cursor.execute('''SELECT tens_exp_id, age, ca_left, ca_avg, ca_right, height,
-                    bd, vol FROM tensiometer_data WHERE tensiometer_data.tens_exp_id = {};'''.format(tens_exp_id))
-    data = cursor.fetchall()
-
-    cursor.execute('SELECT * FROM tensiometer_experiments WHERE tens_exp_id = {};'.format(tens_exp_id))
-    names = [description[0] for description in cursor.description]
-    experiment_values = cursor.fetchone()
-    experiment = {n:b for n,b in zip(names, experiment_values)}
-
-    cursor.execute('SELECT * from binders WHERE binder_id = {};'.format(experiment['binder']))
-    names = [description[0] for description in cursor.description]
-    binder_values = cursor.fetchone()
-    binder = {n:b for n,b in zip(names, binder_values)}
-    
-    return Experiment(data, experiment, binder)
+    return load_experiments([tens_exp_id], cursor.connection)[0]
     
 
+RESULT_HEADER = "tens_exp_id, binder_id, binder_name, binder_type, concentration, date, abs_time, initial_volume, viscosity, surface_tension, smooth_ca, rough_ca, cca_cos_theta, temperature"
+RESULT_COLUMNS = RESULT_HEADER.split(', ')
+
+def result_row(row, absorbance_time):
+    """
+    The output row (see RESULT_HEADER) for a filters.EXPERIMENTS_QUERY row and its absorbance time.
+    """
+    tens_exp_id, binder, binder_name, date, initial_volume, fps, concentration, viscosity, surface_tension, smooth_ca, rough_ca, cca_cos_theta, temperature = (row[0], row[1],
+                row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12])
+    return [tens_exp_id, binder, binder_name, binder_name[0:3], concentration, date, absorbance_time, initial_volume, viscosity, surface_tension, smooth_ca, rough_ca, cca_cos_theta, temperature]
+
+
+def parse_sweep(spec):
+    """
+    Parse a list of percentages, either "70,75,79" or an inclusive range "start:stop:step" such as "50:90:5".
+    Raises ValueError for a malformed spec or a step that isn't positive.
+    """
+    if ':' in spec:
+        start, stop, step = [float(v) for v in spec.split(':')]
+        if step <= 0:
+            raise ValueError('the step must be positive, not {:g}'.format(step))
+        return [float(p) for p in np.round(np.arange(start, stop + step/2, step), 10) if p <= stop]
+    return [float(v) for v in spec.split(',')]
+
+
+def sweep(rows, experiments, percents, wide=False, format='text', output=None):
+    """
+    Write the absorbance time of every experiment at every percentage, either one row per
+    experiment and percentage (long) or one row per experiment with a column per percentage (wide).
+    Rows are written as they're calculated (see export for the formats).
+    """
+    columns = ['tens_exp_id', 'binder_id', 'binder_name', 'binder_type', 'concentration', 'date']
+    if wide:
+        columns += ['abs_time_{:g}'.format(p) for p in percents]
+    else:
+        columns += ['percent_absorbed', 'abs_time']
+    with export.open_writer(format, columns, output) as out:
+        for row in rows:
+            if row[0] not in experiments:
+                continue
+            tens_exp_id, binder, binder_name, date, concentration = row[0], row[1], row[2], row[3], row[6]
+            started = profiling.clock()
+            times = experiments[tens_exp_id].calc_absorbance_times(percents)
+            profiling.experiment_time(tens_exp_id, profiling.clock() - started)
+            experiments[tens_exp_id].release_curve()
+            metadata = [tens_exp_id, binder, binder_name, binder_name[0:3], concentration, date]
+            if wide:
+                out.write(metadata + list(times))
+            else:
+                for p, t in zip(percents, times):
+                    out.write(metadata + [p, t])
+
+
 def main():
     """
     Open the database file and calculate the absorbance time for all (new) experiments.
     """
-    args = sys.argv
-    if len(args) < 3:
-        print('usage: calc-absorbance.py /path/to/data.db percent-absorbed')
-        sys.exit(1)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('database_file', metavar='/path/to/data.db')
+    parser.add_argument('percent_absorbed', metavar='percent-absorbed', type=float, nargs='?')
+    parser.add_argument('--no-cache', action='store_true', help="recalculate every experiment, don't use or update the cache")
+    parser.add_argument('--purge-cache', action='store_true', help='empty the absorbance time cache and exit')
+    parser.add_argument('--filter', metavar='SPEC.json', help='select experiments with a filter spec instead of the default (new data only, minus excludes.txt)')
+    parser.add_argument('--sweep', metavar='PERCENTS', help='calculate several percentages in one pass, e.g. 70,75,79 or 50:90:5')
+    parser.add_argument('--bootstrap', metavar='N', type=int, help='add a bootstrap confidence interval from N resamples of each curve')
+    parser.add_argument('--seed', type=int, default=0, help='random seed for --bootstrap')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes for --bootstrap (default: one per core)')
+    parser.add_argument('--fit', metavar='MODEL', choices=['stretched', 'power', 'washburn'], help='add the absorbance time predicted by fitting a stretched-exponential, power-law or Washburn model to each curve (stretched follows the whole decay)')
+    parser.add_argument('--float32', action='store_true', help='keep the curves in single precision, for half the memory')
+    parser.add_argument('--wide', action='store_true', help='with --sweep, print one column per percentage instead of one row')
+    export.add_arguments(parser)
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    export.check_arguments(parser, args)
+    profiling.from_args(args)
+    if args.sweep:
+        try:
+            percents = parse_sweep(args.sweep)
+        except ValueError as err:
+            parser.error('invalid --sweep {!r}: {}'.format(args.sweep, err))
+    dtype = np.float32 if args.float32 else CURVE_DTYPE
 
-    database_file = sys.argv[1]
-    percent_absorbed = float(sys.argv[2])
+    database_file = args.database_file
+    percent_absorbed = args.percent_absorbed
 
     if os.path.exists(database_file):
-        conn = sqlite3.connect(database_file)
-        c = conn.cursor()
+        # read-only unless results are cached; WAL lets this run alongside an import either way
+        conn = connect(database_file, readonly=args.no_cache and not args.purge_cache)
     else:
         print('Database file could not be found.')
         sys.exit(1)
+
+    if args.purge_cache:
+        print("Removed {} cached absorbance time(s)".format(absorbance_cache.purge(conn)), file=sys.stderr)
+        return
+    if percent_absorbed is None and not args.sweep:
+        parser.error('percent-absorbed is required')
     
     # Strategy:
     # - Get a list of all experiments
@@ -91,34 +513,114 @@ def main():
     
     results = []
     processed_experiments = []
-    c.execute('''SELECT tens_exp_id, binder, binders.name, date, volume, fps, binders.per_conc,
-               binders.viscosity, binders.surface_tension, binders.smooth_ca, binders.rough_ca, binders.cca_cos_theta, temperature
-               FROM tensiometer_experiments LEFT JOIN binders on
-               tensiometer_experiments.binder = binders.binder_id;''')
-    for row in c:
-        tens_exp_id, binder, binder_name, date, initial_volume, fps, concentration, viscosity, surface_tension, smooth_ca, rough_ca, cca_cos_theta, temperature = (row[0], row[1],
-                    row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9], row[10], row[11], row[12])
-        
-        if tens_exp_id < 45 or tens_exp_id in exclusions():
-            continue # new data only
+    with profiling.stage('select'):
+        try:
+            experiment_filter = filters.ExperimentFilter.from_file(args.filter) if args.filter else filters.NEW_DATA
+        except (OSError, ValueError) as err:
+            parser.error('invalid --filter: {}'.format(err))
+        rows = experiment_filter.select(conn)
+        ids = [row[0] for row in rows]
+
+    if args.sweep:
+        with profiling.stage('load'):
+            experiments = {e.experiment['tens_exp_id']: e for e in lazy_experiments(ids, conn, dtype=dtype)}
+        with profiling.stage('sweep'):
+            sweep(rows, experiments, percents, wide=args.wide, format=args.format, output=args.output)
+        if min(percents) < 60:
+            print("Warning: percent _absorbed_, not percent remaining!", file=sys.stderr)
+        profiling.finish(args)
+        return
+
+    # Experiments whose data hasn't changed since the last run come from the cache, only the rest are loaded
+    cached = {}
+    if not args.no_cache:
+        with profiling.stage('cache lookup'):
+            absorbance_cache.ensure_cache(conn)
+            fingerprints = absorbance_cache.with_precision(absorbance_cache.fingerprints(conn, ids), dtype)
+            if not args.bootstrap and not args.fit: # these need all the curves anyway
+                cached = absorbance_cache.lookup(conn, percent_absorbed, fingerprints)
+    with profiling.stage('load'):
+        experiments = lazy_experiments([i for i in ids if i not in cached], conn, dtype=dtype)
+        experiments = {e.experiment['tens_exp_id']: e for e in experiments}
+
+    # rows are written as they're calculated, unless columns are added afterwards from all the curves
+    streaming = not args.bootstrap and not args.fit
+    out = export.open_writer(args.format, RESULT_COLUMNS, args.output) if streaming else None
+
+    with profiling.stage('absorbance'):
+        new_entries = []
+        try:
+            for row in rows:
+                tens_exp_id = row[0]
         
-        processed_experiment = getExperiment(tens_exp_id, conn.cursor())
-        if processed_experiment.calc_absorbance_time(percent_absorbed) == 0:
-            continue
-        processed_experiments.append(processed_experiment)
-        results.append([tens_exp_id, binder, binder_name, binder_name[0:3], concentration, date, processed_experiment.absorbance_time, initial_volume, viscosity, surface_tension, smooth_ca, rough_ca, cca_cos_theta, temperature])
-    # Print the column headers, then the data entries
-    print("tens_exp_id, binder_id, binder_name, binder_type, concentration, date, abs_time, initial_volume, viscosity, surface_tension, smooth_ca, rough_ca, cca_cos_theta, temperature")
-    for r in results:
-        print(' '.join([str(e) for e in r]))
+                if tens_exp_id in cached:
+                    absorbance_time, extrapolated = cached[tens_exp_id]
+                    if extrapolated:
+                        print("Warning, extrapolated absorbance time for experiment {} (cached)".format(tens_exp_id), file=sys.stderr)
+                elif tens_exp_id in experiments:
+                    processed_experiment = experiments[tens_exp_id]
+                    started = profiling.clock()
+                    absorbance_time = processed_experiment.calc_absorbance_time(percent_absorbed)
+                    profiling.experiment_time(tens_exp_id, profiling.clock() - started)
+                    processed_experiments.append(processed_experiment)
+                    if not args.bootstrap and not args.fit: # only the absorbance time is needed from here on
+                        processed_experiment.release_curve()
+                    if not args.no_cache:
+                        new_entries.append((tens_exp_id, fingerprints[tens_exp_id], absorbance_time, processed_experiment.extrapolated))
+                else:
+                    continue
+                if absorbance_time == 0:
+                    continue
+                if streaming:
+                    out.write(result_row(row, absorbance_time))
+                else:
+                    results.append(result_row(row, absorbance_time))
+        finally:
+            # saved whatever happens to the output (e.g. a closed pipe), so the work isn't lost
+            if new_entries:
+                absorbance_cache.store(conn, percent_absorbed, new_entries)
+            if streaming:
+                out.close()
+    if profiling.enabled():
+        profiling.experiment_memory(memory_usage(processed_experiments))
+    columns = list(RESULT_COLUMNS)
+    if args.bootstrap:
+        import bootstrap
+        with profiling.stage('bootstrap'):
+            intervals = bootstrap.bootstrap(processed_experiments, percent_absorbed, n=args.bootstrap, seed=args.seed, workers=args.jobs)
+        columns += ['abs_time_median', 'abs_time_ci_low', 'abs_time_ci_high']
+        for r in results:
+            r.extend(intervals[r[0]])
+    if args.fit:
+        import fitting
+        with profiling.stage('fit'):
+            fits = fitting.fit(processed_experiments, args.fit)
+            fit_times = dict(zip(fits.ids, fits.absorbance_times(percent_absorbed)))
+            fit_rms = dict(zip(fits.ids, fits.rms))
+            fit_parameters = fits.parameters()
+        columns += ['fit_abs_time'] + ['fit_' + name for name in fits.parameter_names()] + ['fit_rms']
+        for r in results:
+            r.extend([fit_times[r[0]]] + list(fit_parameters[r[0]].values()) + [fit_rms[r[0]]])
+    # Write the column headers, then the data entries
+    with profiling.stage('output'):
+        if not streaming:
+            with export.open_writer(args.format, columns, args.output) as out:
+                for r in results:
+                    out.write(r)
     
     #plot(processed_experiments)
     
 
     if (percent_absorbed < 60):
         print("Warning: percent _absorbed_, not percent remaining!", file=sys.stderr)
+    profiling.finish(args)
 
 
 # Main body
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    try:
+        main()
+    except BrokenPipeError:
+        # the reader went away (e.g. | head): stop quietly, without another error when stdout is flushed at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(0)
\ No newline at end of file
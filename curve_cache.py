@@ -0,0 +1,196 @@
+#!/usr/local/bin/python3.7
+"""
+Columnar cache of the curve data, kept next to the sqlite database (data.sqlite.curves/). Each column
+of the processed curves (time in s, volume) is one flat binary file of float64s, and index.json holds
+the offset, length and data fingerprint of every experiment. The files are opened with memory mapping,
+so experiments loaded from the cache are views into it rather than millions of decoded sqlite rows.
+
+Updates hold an exclusive lock on the directory, re-read the index under it, and cut the column files
+back to the size the index records before appending, so an interrupted or concurrent update can't leave
+curves the index doesn't describe.
+"""
+
+import os
+import json
+from contextlib import contextmanager
+import numpy as np
+
+try:
+    import fcntl
+except ImportError: # not on Windows
+    fcntl = None
+
+import calc_absorbance
+from absorbance_cache import fingerprints
+
+COLUMNS = ('x', 'y')
+DTYPE = np.float64
+
+
+class CurveCache():
+
+    def __init__(self, database_file, directory=None):
+        self.directory = directory or database_file + '.curves'
+        self._load_index()
+
+    def _load_index(self):
+        self.index = {} # tens_exp_id -> [start, count, fingerprint]
+        self.size = 0 # number of values in each column file, including superseded curves
+        self._index_mtime = None
+        index_file = os.path.join(self.directory, 'index.json')
+        if os.path.exists(index_file):
+            self._index_mtime = os.stat(index_file).st_mtime_ns
+            with open(index_file) as f:
+                saved = json.load(f)
+            self.index = {int(i): entry for i, entry in saved['experiments'].items()}
+            self.size = saved['size']
+
+    @contextmanager
+    def _locked(self, shared=False):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, 'lock'), 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _path(self, column):
+        return os.path.join(self.directory, column + '.f64')
+
+    def _save_index(self):
+        index_file = os.path.join(self.directory, 'index.json')
+        with open(index_file + '.tmp', 'w') as f:
+            json.dump({'size': self.size, 'experiments': self.index}, f)
+        os.replace(index_file + '.tmp', index_file)
+
+    def column(self, name):
+        if self.size == 0:
+            return np.empty(0, dtype=DTYPE)
+        return np.memmap(self._path(name), dtype=DTYPE, mode='r', shape=(self.size,))
+
+    def update(self, conn, tens_exp_ids):
+        """
+        Add the given experiments to the cache, or replace them if their rows changed since they were cached,
+        and drop the experiments that are no longer in the database. Replaced curves are appended, and the
+        files are compacted once more than half of them is stale.
+        """
+        current = fingerprints(conn, tens_exp_ids)
+        known = {row[0] for row in conn.execute('SELECT tens_exp_id FROM tensiometer_experiments;')}
+        if not any(self._changes(tens_exp_ids, current, known)):
+            return
+        with self._locked():
+            # another process may have updated the cache since it was read
+            self._load_index()
+            stale, gone = self._changes(tens_exp_ids, current, known)
+            if not stale and not gone:
+                return
+            for i in gone:
+                del self.index[i]
+            if stale:
+                self._append(conn, stale, current)
+            if sum(count for start, count, fingerprint in self.index.values()) < self.size / 2:
+                self.compact()
+            self._save_index()
+
+    def _changes(self, tens_exp_ids, current, known):
+        """
+        The experiments to (re)cache and the ones to drop, as two (possibly empty) lists.
+        """
+        stale = [i for i in tens_exp_ids if i in current and (i not in self.index or self.index[i][2] != current[i])]
+        requested = set(tens_exp_ids)
+        gone = [i for i in self.index if i not in known or (i in requested and i not in current)]
+        return stale, gone
+
+    def _append(self, conn, stale, current):
+        experiments, binders = calc_absorbance.load_metadata(stale, conn)
+        files = {name: open(self._path(name), 'ab') for name in COLUMNS}
+        try:
+            # anything past the indexed size is left over from an interrupted update
+            for f in files.values():
+                f.truncate(self.size * np.dtype(DTYPE).itemsize)
+            # a batch of curves at a time, so memory doesn't grow with the number of stale experiments
+            batch_size = calc_absorbance.CURVE_BATCH_SIZE
+            for b in range(0, len(stale), batch_size):
+                for tens_exp_id, (x, y) in calc_absorbance.load_curves(stale[b:b+batch_size], conn, experiments).items():
+                    files['x'].write(np.asarray(x, dtype=DTYPE).tobytes())
+                    files['y'].write(np.asarray(y, dtype=DTYPE).tobytes())
+                    self.index[tens_exp_id] = [self.size, len(x), current[tens_exp_id]]
+                    self.size += len(x)
+        finally:
+            for f in files.values():
+                f.close()
+
+    def compact(self):
+        """
+        Rewrite the column files with only the current curves.
+        """
+        order = sorted(self.index.items(), key=lambda item: item[1][0])
+        for name in COLUMNS:
+            old = self.column(name)
+            with open(self._path(name) + '.tmp', 'wb') as f:
+                for tens_exp_id, (start, count, fingerprint) in order:
+                    f.write(old[start:start+count].tobytes())
+            del old
+            os.replace(self._path(name) + '.tmp', self._path(name))
+        size = 0
+        for tens_exp_id, entry in order:
+            entry[0] = size
+            size += entry[1]
+        self.size = size
+
+    def curves(self, tens_exp_ids):
+        """
+        The cached curves of the given experiments, as {tens_exp_id: (x, y)} views into the memory map.
+        """
+        with self._locked(shared=True):
+            # the files may have been compacted by another process since the index was read
+            index_file = os.path.join(self.directory, 'index.json')
+            if os.path.exists(index_file) and os.stat(index_file).st_mtime_ns != self._index_mtime:
+                self._load_index()
+            x, y = self.column('x'), self.column('y')
+        curves = {}
+        for i in tens_exp_ids:
+            if i in self.index:
+                start, count, fingerprint = self.index[i]
+                curves[i] = (x[start:start+count], y[start:start+count])
+        return curves
+
+    def load_experiments(self, tens_exp_ids, conn, dtype=calc_absorbance.CURVE_DTYPE):
+        """
+        Like calc_absorbance.lazy_experiments, but the curves are views into the memory-mapped cache.
+        The cache is brought up to date first.
+        """
+        self.update(conn, tens_exp_ids)
+        experiments, binders = calc_absorbance.load_metadata(tens_exp_ids, conn)
+        loader = CachedCurveLoader(self.directory, dtype=dtype)
+        loader._cache = self
+        loaded = []
+        for i in tens_exp_ids:
+            if i not in self.index or i not in experiments:
+                continue
+            experiment = experiments[i]
+            loaded.append(calc_absorbance.Experiment.from_metadata(experiment, binders.get(experiment['binder']), loader))
+        return loaded
+
+
+class CachedCurveLoader(calc_absorbance.CurveLoader):
+    """
+    Loads the curves of lazily-built Experiments from the curve cache instead of sqlite. It only holds the
+    cache directory, so experiments sent to worker processes map the cache there rather than being copied.
+    """
+
+    def __init__(self, directory, batch_size=calc_absorbance.CURVE_BATCH_SIZE, dtype=calc_absorbance.CURVE_DTYPE):
+        super().__init__(None, batch_size, dtype)
+        self.directory = directory
+        self._cache = None
+
+    def fetch(self, experiments):
+        if self._cache is None:
+            self._cache = CurveCache(None, self.directory)
+        return self._cache.curves(experiments)
+
+    def __getstate__(self):
+        return dict(self.__dict__, pending={}, _cache=None)
@@ -0,0 +1,134 @@
+#!/usr/local/bin/python3.7
+"""
+Helpers for working with the experiments database that are shared between the scripts.
+"""
+
+import os
+import sys
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.request import pathname2url
+
+import profiling
+
+# How long to wait for another process's write transaction before giving up, in seconds
+BUSY_TIMEOUT = 30
+
+
+def connect(database_file, readonly=False, wal=True, timeout=BUSY_TIMEOUT, snapshot=False, **kwargs):
+    """
+    Open the experiments database.
+
+    readonly    open it through a read-only URI (file:...?mode=ro), for the analysis scripts: they can't
+                take write locks, so they never get in the way of an import
+    wal         switch the database to write-ahead logging (it stays that way), so readers and the one
+                writer don't block each other; synchronous=NORMAL is safe in WAL mode
+    timeout     seconds to wait on a lock held by another connection
+    snapshot    copy the whole database into memory and return a connection to the copy, for read-heavy
+                batch runs; nothing written to it is saved. The copy only exists in this process, so
+                lazily-built experiments on it can't be sent to worker processes.
+
+    A read-write connection also creates the indexes (ensure_indexes), so the read-only ones find them.
+    """
+    if readonly:
+        uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(database_file)))
+        conn = profiling.connect(uri, uri=True, timeout=timeout, **kwargs)
+    else:
+        conn = profiling.connect(database_file, timeout=timeout, **kwargs)
+        if wal:
+            try:
+                if conn.execute('PRAGMA journal_mode = WAL;').fetchone()[0].lower() == 'wal':
+                    conn.execute('PRAGMA synchronous = NORMAL;')
+            except sqlite3.OperationalError as err: # e.g. another connection is in the middle of a transaction
+                print("Could not switch to WAL mode: {}".format(err), file=sys.stderr)
+        ensure_indexes(conn)
+    if snapshot:
+        memory = profiling.connect(':memory:', **kwargs)
+        conn.backup(memory)
+        conn.close()
+        return memory
+    return conn
+
+
+class ConnectionPool():
+    """
+    A few reusable connections to one database, shared by the threads of a process (e.g. by the curve
+    loaders of a worker process). At most size connections are opened; connection() waits for a free one.
+    """
+
+    def __init__(self, database_file, size=4, **kwargs):
+        self.database_file = database_file
+        self.size = size
+        self.kwargs = dict(kwargs, check_same_thread=False)
+        self._free = []
+        self._opened = 0
+        self._available = threading.Condition()
+
+    @contextmanager
+    def connection(self):
+        with self._available:
+            while not self._free and self._opened >= self.size:
+                self._available.wait()
+            if self._free:
+                conn = self._free.pop()
+            else:
+                conn = None
+                self._opened += 1
+        if conn is None:
+            try:
+                conn = connect(self.database_file, **self.kwargs)
+            except BaseException:
+                with self._available:
+                    self._opened -= 1
+                    self._available.notify()
+                raise
+        try:
+            yield conn
+        finally:
+            with self._available:
+                self._free.append(conn)
+                self._available.notify()
+
+    def close(self):
+        with self._available:
+            for conn in self._free:
+                conn.close()
+            self._opened -= len(self._free)
+            self._free = []
+
+
+_pools = {}
+
+def pool(database_file, readonly=True, size=4):
+    """
+    The pool of this process for a database (read-only by default), created on first use.
+    """
+    key = (os.path.abspath(database_file), readonly)
+    if key not in _pools:
+        _pools.setdefault(key, ConnectionPool(database_file, size, readonly=readonly))
+    return _pools[key]
+
+
+def ensure_indexes(conn):
+    """
+    Make sure the curve data can be looked up by experiment without a full table scan (once there is any).
+    """
+    if conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'tensiometer_data';").fetchone() is None:
+        return
+    try:
+        conn.execute('CREATE INDEX IF NOT EXISTS tensiometer_data_tens_exp_id ON tensiometer_data (tens_exp_id);')
+        conn.commit()
+    except sqlite3.OperationalError as err: # e.g. a read-only database
+        print("Could not create index on tensiometer_data: {}".format(err), file=sys.stderr)
+
+
+def select_experiments(cursor, tens_exp_ids, table='selected_experiments'):
+    """
+    Put the requested experiment ids in a temporary table, so that they can be joined against
+    (there are too many of them for an IN (...) list). The table is per connection, so code that can run
+    in the middle of another selection (like the lazy curve loads) should use a table of its own.
+    """
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS {} (tens_exp_id INTEGER PRIMARY KEY);'.format(table))
+    cursor.execute('DELETE FROM {};'.format(table))
+    cursor.executemany('INSERT OR IGNORE INTO {} (tens_exp_id) VALUES (?);'.format(table), [(i,) for i in tens_exp_ids])
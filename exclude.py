@@ -5,9 +5,18 @@ Module to exclude 'bad' experimental runs. Mostly repeated runs where the previo
 
 import os
 
-def exclusions():
-    f = "excludes.txt"
-    e = []
-    if os.path.exists(f):
-        e = [ int(l.strip()) for l in open(f).readlines()]
-    return e
\ No newline at end of file
+# file name -> (mtime, exclusions), so the file is only re-read when it changes
+_cache = {}
+
+def exclusions(f="excludes.txt"):
+    """
+    Return the set of excluded tens_exp_ids listed in the file, one per line.
+    """
+    try:
+        mtime = os.stat(f).st_mtime_ns
+    except FileNotFoundError:
+        return frozenset()
+    if f not in _cache or _cache[f][0] != mtime:
+        with open(f) as lines:
+            _cache[f] = (mtime, frozenset(int(l.strip()) for l in lines if l.strip()))
+    return _cache[f][1]
@@ -0,0 +1,150 @@
+#!/usr/local/bin/python3.7
+"""
+Write result rows as they're computed, in one of several formats:
+
+    text     space-separated values under a comma-separated header (the scripts' usual output)
+    csv      quoted as needed, so binder names with spaces or commas stay in their column
+    jsonl    one JSON object per row
+    parquet  typed columnar file, written a row group at a time (needs pyarrow)
+
+Every column has a type (see column_type), which the csv, jsonl and parquet writers convert the values
+to, so the files load into analysis tools without re-parsing. Missing values and NaN are written as
+empty fields, null or Parquet nulls.
+"""
+
+import sys
+import csv
+import json
+import math
+import importlib.util
+from abc import ABC, abstractmethod
+
+FORMATS = ('text', 'csv', 'jsonl', 'parquet')
+
+# Columns that aren't floats
+TYPES = {'tens_exp_id': int, 'binder_id': int, 'binder_name': str, 'binder_type': str, 'date': str}
+
+# Rows per Parquet row group, i.e. how many rows are held in memory before being written
+ROW_GROUP_SIZE = 10000
+
+
+def column_type(name):
+    return TYPES.get(name, float)
+
+
+def parquet_available():
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+class Writer(ABC):
+    """
+    Writes rows (lists in the order of columns) to a file, or to stdout if output is None.
+    """
+
+    def __init__(self, columns, output=None, mode='w', newline=None):
+        self.columns = list(columns)
+        self.types = [column_type(c) for c in self.columns]
+        self.file = sys.stdout if output is None else open(output, mode, newline=newline)
+
+    def typed(self, row):
+        values = []
+        for value, kind in zip(row, self.types):
+            if value is None or (kind is float and math.isnan(value)):
+                values.append(None)
+            else:
+                values.append(kind(value))
+        return values
+
+    @abstractmethod
+    def write(self, row):
+        pass
+
+    def close(self):
+        if self.file is not sys.stdout:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class TextWriter(Writer):
+
+    def __init__(self, columns, output=None):
+        super().__init__(columns, output)
+        print(', '.join(self.columns), file=self.file)
+
+    def write(self, row):
+        print(' '.join([str(e) for e in row]), file=self.file)
+
+
+class CsvWriter(Writer):
+
+    def __init__(self, columns, output=None):
+        super().__init__(columns, output, newline='')
+        self.csv = csv.writer(self.file)
+        self.csv.writerow(self.columns)
+
+    def write(self, row):
+        self.csv.writerow(['' if v is None else v for v in self.typed(row)])
+
+
+class JsonLinesWriter(Writer):
+
+    def write(self, row):
+        print(json.dumps(dict(zip(self.columns, self.typed(row)))), file=self.file)
+
+
+class ParquetWriter(Writer):
+
+    def __init__(self, columns, output):
+        import pyarrow
+        import pyarrow.parquet
+        self.columns = list(columns)
+        self.types = [column_type(c) for c in self.columns]
+        arrow_types = {int: pyarrow.int64(), float: pyarrow.float64(), str: pyarrow.string()}
+        self.schema = pyarrow.schema([(c, arrow_types[t]) for c, t in zip(self.columns, self.types)])
+        self.table = pyarrow.Table
+        self.file = pyarrow.parquet.ParquetWriter(output, self.schema)
+        self.pending = []
+
+    def write(self, row):
+        self.pending.append(self.typed(row))
+        if len(self.pending) >= ROW_GROUP_SIZE:
+            self.flush()
+
+    def flush(self):
+        if self.pending:
+            columns = {c: [row[i] for row in self.pending] for i, c in enumerate(self.columns)}
+            self.file.write_table(self.table.from_pydict(columns, schema=self.schema))
+            self.pending = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+
+WRITERS = {'text': TextWriter, 'csv': CsvWriter, 'jsonl': JsonLinesWriter, 'parquet': ParquetWriter}
+
+def open_writer(format, columns, output=None):
+    """
+    A writer for the given format and columns. Parquet needs an output file; the others default to stdout.
+    """
+    if format == 'parquet' and output is None:
+        raise ValueError('Parquet output needs a file')
+    return WRITERS[format](columns, output)
+
+
+def add_arguments(parser):
+    parser.add_argument('--format', choices=FORMATS, default='text', help='output format (default: text; parquet needs pyarrow and --output)')
+    parser.add_argument('--output', metavar='FILE', help='write the results to this file instead of stdout')
+
+
+def check_arguments(parser, args):
+    if args.format == 'parquet':
+        if not args.output:
+            parser.error('--format parquet needs --output')
+        if not parquet_available():
+            parser.error('--format parquet needs pyarrow (pip install pyarrow)')
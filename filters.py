@@ -0,0 +1,156 @@
+#!/usr/local/bin/python3.7
+"""
+Declarative selection of experiments. A filter spec is compiled into a parameterized WHERE clause, so
+experiments we don't want are never loaded from the database in the first place.
+"""
+
+import copy
+import json
+import inspect
+from exclude import exclusions
+from db import select_experiments
+import summary
+
+# The experiment and binder properties used by the scripts, one row per experiment
+EXPERIMENTS_QUERY = '''SELECT tens_exp_id, binder, binders.name, date, volume, fps, binders.per_conc,
+                       binders.viscosity, binders.surface_tension, binders.smooth_ca, binders.rough_ca,
+                       binders.cca_cos_theta, temperature FROM tensiometer_experiments LEFT JOIN binders on
+                       tensiometer_experiments.binder = binders.binder_id'''
+
+
+class ExperimentFilter():
+    """
+    Which experiments to use. All the conditions must hold; unset ones are ignored.
+
+    min_id, max_id                  range of tens_exp_id (inclusive)
+    exclude_ids                     tens_exp_ids to skip
+    excludes_file                   file of tens_exp_ids to skip, one per line (None to not use one)
+    binder_patterns                 the binder name must contain at least one of these
+    exclude_binder_patterns         the binder name must contain none of these
+    min_temperature, max_temperature
+    min_volume, max_volume          initial drop volume
+    ids                             only these tens_exp_ids
+    min_points                      minimum number of data points in the curve
+    reaches_percent                 the measured curve reaches this absorbed percentage, so its absorbance
+                                    time there is interpolated rather than extrapolated
+
+    The last two are answered from tensiometer_summary, without reading the curves.
+    """
+
+    def __init__(self, min_id=None, max_id=None, exclude_ids=(), excludes_file="excludes.txt",
+                 binder_patterns=(), exclude_binder_patterns=(), min_temperature=None, max_temperature=None,
+                 min_volume=None, max_volume=None, min_points=None, reaches_percent=None, ids=None):
+        self.min_id = min_id
+        self.max_id = max_id
+        self.exclude_ids = list(exclude_ids)
+        self.excludes_file = excludes_file
+        self.binder_patterns = list(binder_patterns)
+        self.exclude_binder_patterns = list(exclude_binder_patterns)
+        self.min_temperature = min_temperature
+        self.max_temperature = max_temperature
+        self.min_volume = min_volume
+        self.max_volume = max_volume
+        self.min_points = min_points
+        self.reaches_percent = reaches_percent
+        self.ids = None if ids is None else list(ids)
+
+    def only(self, tens_exp_ids):
+        """
+        A copy of this filter that also requires the experiment to be one of tens_exp_ids.
+        """
+        restricted = copy.copy(self)
+        restricted.ids = list(tens_exp_ids)
+        return restricted
+
+    @classmethod
+    def from_file(cls, filename):
+        """
+        Read a spec from a JSON file, with the same keys as the constructor arguments. Raises ValueError
+        for a file that isn't a JSON object of known keys (and OSError if it can't be read).
+        """
+        with open(filename) as f:
+            spec = json.load(f)
+        if not isinstance(spec, dict):
+            raise ValueError("{}: not a JSON object".format(filename))
+        known = inspect.signature(cls).parameters
+        unknown = sorted(key for key in spec if key not in known)
+        if unknown:
+            raise ValueError("{}: unknown key(s) {} (known: {})".format(filename, ', '.join(unknown), ', '.join(known)))
+        return cls(**spec)
+
+    def where(self, summary_table='tensiometer_summary'):
+        """
+        Compile the spec into a WHERE clause (without the WHERE) and its parameters. summary_table is what
+        the summary conditions select from (see summary.source). The ids to keep and to exclude are
+        selected from the filter_ids and filter_excluded temporary tables, which select() fills in.
+        """
+        clauses = []
+        params = []
+
+        def bound(column, op, value):
+            if value is not None:
+                clauses.append('{} {} ?'.format(column, op))
+                params.append(value)
+
+        bound('tens_exp_id', '>=', self.min_id)
+        bound('tens_exp_id', '<=', self.max_id)
+        bound('temperature', '>=', self.min_temperature)
+        bound('temperature', '<=', self.max_temperature)
+        bound('volume', '>=', self.min_volume)
+        bound('volume', '<=', self.max_volume)
+        if self.ids is not None:
+            clauses.append('tens_exp_id IN (SELECT tens_exp_id FROM filter_ids)')
+
+        if self.min_points is not None:
+            clauses.append('tens_exp_id IN (SELECT tens_exp_id FROM {} WHERE n_points >= ?)'.format(summary_table))
+            params.append(self.min_points)
+        if self.reaches_percent is not None:
+            # the same test as Experiment.calc_absorbance_time, on the first and last usable volumes
+            clauses.append('''tens_exp_id IN (SELECT tens_exp_id FROM {} JOIN tensiometer_experiments USING (tens_exp_id)
+                              WHERE last_usable_vol <= (100 - ?) / 100.0 * volume AND first_usable_vol >= (100 - ?) / 100.0 * volume)'''.format(summary_table))
+            params.extend([self.reaches_percent, self.reaches_percent])
+
+        if self.excluded():
+            clauses.append('tens_exp_id NOT IN (SELECT tens_exp_id FROM filter_excluded)')
+
+        # instr() rather than LIKE, to keep the case-sensitive substring matching of `'pvp' in name`
+        if self.binder_patterns:
+            clauses.append('(' + ' OR '.join('instr(binders.name, ?) > 0' for p in self.binder_patterns) + ')')
+            params.extend(self.binder_patterns)
+        for p in self.exclude_binder_patterns:
+            clauses.append('instr(binders.name, ?) = 0')
+            params.append(p)
+
+        return ' AND '.join(clauses) or '1', params
+
+    def excluded(self):
+        """
+        The tens_exp_ids to skip, from exclude_ids and the excludes file.
+        """
+        excluded = set(self.exclude_ids)
+        if self.excludes_file:
+            excluded |= exclusions(self.excludes_file)
+        return excluded
+
+    def select(self, conn):
+        """
+        Return the EXPERIMENTS_QUERY rows of the experiments that pass the filter, ordered by tens_exp_id.
+        """
+        summary_table = 'tensiometer_summary'
+        if self.min_points is not None or self.reaches_percent is not None:
+            summary_table = summary.source(conn)
+        where, params = self.where(summary_table)
+        c = conn.cursor()
+        # too many for an IN (...) list, e.g. every experiment watch has imported
+        if self.ids is not None:
+            select_experiments(c, self.ids, table='filter_ids')
+        excluded = self.excluded()
+        if excluded:
+            select_experiments(c, excluded, table='filter_excluded')
+        c.execute(EXPERIMENTS_QUERY + ' WHERE ' + where + ' ORDER BY tens_exp_id;', params)
+        return c.fetchall()
+
+
+# The selections the scripts have always used
+NEW_DATA = ExperimentFilter(min_id=45)
+LOW_HIGH_ROOM_TEMPERATURE = ExperimentFilter(binder_patterns=['-low', '-high'], max_temperature=30)
@@ -0,0 +1,155 @@
+#!/usr/local/bin/python3.7
+"""
+Fit a parametric absorption model to the curve of every experiment at once, as an alternative to
+interpolating the absorbance time. Every model starts from the initial drop volume V0 at t = 0, and is
+linear in log t and a transformed volume, so each fit is a weighted least-squares line, and the lines
+of all the experiments are solved together in closed form from per-experiment sums (np.add.reduceat
+over the concatenated curves).
+
+    stretched: vol = V0 exp(-(t/tau)^beta)   (log(-log(vol/V0)) against log t)
+    power:     vol = V0 - k t^n              (log(V0 - vol) against log t)
+    washburn:  vol = V0 - k sqrt(t)          (the power law with n = 1/2)
+
+Only the decay is fitted, the points between DECAY of V0: the first and last points carry almost no
+information after the transform and are dominated by the reading noise (and the tail after the drop
+is gone isn't absorption at all). Each point is weighted by the inverse of its variance in the
+transformed volume, for a constant noise in volume, so the line is close to a fit in volume itself.
+
+The fitted model gives an absorbance time for any threshold, including ones the curve never reached.
+On the synthetic database the stretched exponential's times are within about 1% of the interpolated
+ones between 50 and 90% absorbed. The power laws only follow part of the decay: both are about 5% off
+at 79%, and further out (or for Washburn, wherever the exponent isn't 1/2) 10-20%. The reported
+residual is the RMS error in volume over the whole curve.
+"""
+
+import numpy as np
+
+# The part of the curve that is fitted, as fractions of the initial volume
+DECAY = (0.1, 0.9)
+
+
+class Model():
+    """
+    A model w = a + b log t, with w a transformed volume. weight() is the inverse variance of w for a
+    constant noise in volume, i.e. 1 / (dw/dvol)^2. A model with a fixed slope only fits a.
+    """
+
+    def __init__(self, name, w, weight, volume, time, slope=None):
+        self.name = name
+        self.w = w # (vol, V0) -> w
+        self.weight = weight # (vol, V0) -> weight
+        self.volume = volume # (a, b, t, V0) -> vol
+        self.time = time # (a, b, vol, V0) -> t
+        self.slope = slope
+
+
+def _power_law(name, slope=None):
+    return Model(name, w=lambda v, V0: np.log(V0 - v), weight=lambda v, V0: (V0 - v)**2,
+                 volume=lambda a, b, t, V0: V0 - np.exp(a) * t**b,
+                 time=lambda a, b, v, V0: np.exp((np.log(V0 - v) - a) / b), slope=slope)
+
+
+MODELS = {
+    'stretched': Model('stretched', w=lambda v, V0: np.log(-np.log(v / V0)), weight=lambda v, V0: (v * np.log(v / V0))**2,
+                       volume=lambda a, b, t, V0: V0 * np.exp(-np.exp(a) * t**b),
+                       time=lambda a, b, v, V0: np.exp((np.log(-np.log(v / V0)) - a) / b)),
+    'power': _power_law('power'),
+    'washburn': _power_law('washburn', slope=0.5),
+}
+
+
+class Fits():
+    """
+    The fits of one model to a list of experiments, as arrays in the experiments' order: intercept a,
+    slope b, rms (residual in volume), n (points fitted). Experiments with fewer than two points in the
+    decay have NaN parameters.
+    """
+
+    def __init__(self, model, experiments, a, b, rms, n):
+        self.model = model
+        self.ids = [e.experiment['tens_exp_id'] for e in experiments]
+        self.initial_volumes = np.array([e.experiment['volume'] for e in experiments], dtype=np.float64)
+        self.a, self.b, self.rms, self.n = a, b, rms, n
+
+    def absorbance_times(self, percent_absorbed):
+        """
+        Model-predicted time at which percent_absorbed of each experiment's initial volume has been absorbed.
+        """
+        target = ((100 - percent_absorbed) / 100) * self.initial_volumes
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            return self.model.time(self.a, self.b, target, self.initial_volumes)
+
+    def _named(self):
+        if self.model.name == 'stretched':
+            with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+                return dict(tau=np.exp(-self.a / self.b), beta=self.b)
+        if self.model.name == 'washburn':
+            return dict(k=np.exp(self.a))
+        return dict(k=np.exp(self.a), n=self.b)
+
+    def parameter_names(self):
+        """
+        The names of the parameters() of every experiment, also when there are no experiments.
+        """
+        return list(self._named())
+
+    def parameters(self):
+        """
+        The fitted parameters in the model's own terms, as {tens_exp_id: {name: value}}.
+        """
+        named = self._named()
+        return {i: {name: float(values[j]) for name, values in named.items()} for j, i in enumerate(self.ids)}
+
+
+def fit(experiments, model='stretched'):
+    """
+    Fit the model to every experiment's curve with one batched weighted least-squares solve.
+    """
+    model = MODELS[model]
+    us, ws, weights, ts, vs = [], [], [], [], []
+    for e in experiments:
+        V0 = e.experiment['volume']
+        keep = (e.x > 0) & (e.y > DECAY[0] * V0) & (e.y < DECAY[1] * V0)
+        v = np.asarray(e.y[keep], dtype=np.float64)
+        us.append(np.log(np.asarray(e.x[keep], dtype=np.float64)))
+        ws.append(model.w(v, V0))
+        weights.append(model.weight(v, V0))
+        # the residual is over the whole curve, to show how much of it the model describes
+        measured = e.x > 0
+        ts.append(np.asarray(e.x[measured], dtype=np.float64))
+        vs.append(np.asarray(e.y[measured], dtype=np.float64))
+    n = np.array([len(u) for u in us])
+    a = np.full(len(experiments), np.nan)
+    b = np.full(len(experiments), np.nan)
+    rms = np.full(len(experiments), np.nan)
+    fitted = n >= 2 # reduceat needs non-empty segments, and a line needs two points
+    if not fitted.any():
+        return Fits(model, experiments, a, b, rms, n)
+
+    u = np.concatenate([u for u, f in zip(us, fitted) if f])
+    w = np.concatenate([w for w, f in zip(ws, fitted) if f])
+    weight = np.concatenate([weight for weight, f in zip(weights, fitted) if f])
+    starts = np.r_[0, np.cumsum(n[fitted])[:-1]]
+    s = np.add.reduceat(weight, starts)
+    s_u = np.add.reduceat(weight * u, starts)
+    s_w = np.add.reduceat(weight * w, starts)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if model.slope is None:
+            s_uu = np.add.reduceat(weight * u * u, starts)
+            s_uw = np.add.reduceat(weight * u * w, starts)
+            slope = (s * s_uw - s_u * s_w) / (s * s_uu - s_u**2)
+        else:
+            slope = np.full(len(s), model.slope)
+        intercept = (s_w - slope * s_u) / s
+    a[fitted], b[fitted] = intercept, slope
+
+    # residuals in volume, per experiment
+    counts = np.array([len(t) for t, f in zip(ts, fitted) if f])
+    t = np.concatenate([t for t, f in zip(ts, fitted) if f])
+    v = np.concatenate([v for v, f in zip(vs, fitted) if f])
+    V0 = np.array([e.experiment['volume'] for e, f in zip(experiments, fitted) if f], dtype=np.float64)
+    segment = np.repeat(np.arange(len(counts)), counts)
+    with np.errstate(over='ignore', invalid='ignore'):
+        error = v - model.volume(intercept[segment], slope[segment], t, V0[segment])
+    rms[fitted] = np.sqrt(np.add.reduceat(error**2, np.r_[0, np.cumsum(counts)[:-1]]) / counts)
+    return Fits(model, experiments, a, b, rms, n)
@@ -0,0 +1,104 @@
+#!/usr/local/bin/python3.7
+"""
+Summary statistics for groups of absorbance times, shared by the plot functions. All the groups of a
+figure are summarized in one vectorized pass into a GroupTable, which the plots draw from and which can
+be exported or reused by other figures.
+"""
+
+import csv
+import numpy as np
+
+
+class GroupTable():
+    """
+    One row per group: key, n, mean, std (population, as np.std), dof, ci (the half-width of the 95 %
+    one-sided t-interval, t(0.95, dof) * std) and, when x values were given, x_mean.
+    """
+    columns = ('n', 'mean', 'std', 'dof', 'ci', 'x_mean')
+
+    def __init__(self, keys, **columns):
+        self.keys = list(keys)
+        self.data = columns
+        self._rows = {k: i for i, k in enumerate(self.keys)}
+
+    def __getitem__(self, column):
+        return self.data[column]
+
+    def __len__(self):
+        return len(self.keys)
+
+    def row(self, key):
+        i = self._rows[key]
+        return {column: values[i] for column, values in self.data.items()}
+
+    def select(self, keys):
+        """
+        The rows for the given keys, in that order, as a new table.
+        """
+        i = [self._rows[k] for k in keys]
+        return GroupTable(keys, **{column: values[i] for column, values in self.data.items()})
+
+    def to_csv(self, filename):
+        with open(filename, 'w', newline='') as f:
+            w = csv.writer(f)
+            columns = [c for c in self.columns if c in self.data]
+            w.writerow(['group'] + columns)
+            for i, k in enumerate(self.keys):
+                w.writerow([k] + [self.data[c][i] for c in columns])
+
+
+def _padded(groups):
+    """
+    Stack groups of different sizes into one NaN-padded 2D array.
+    """
+    lengths = np.array([len(g) for g in groups])
+    values = np.full((len(groups), max(lengths, default=0)), np.nan)
+    mask = np.arange(values.shape[1]) < lengths[:, None]
+    values[mask] = np.concatenate([np.asarray(g, dtype=np.float64) for g in groups]) if len(groups) else []
+    return values, lengths
+
+
+def summarize(groups, x=None, cache=None):
+    """
+    Summarize {key: [values]} (and optionally {key: [x values]}) into a GroupTable with the keys in order.
+    With a cache dict, tables are cached in it on their contents, so figures that share groups don't
+    recompute them; the caller decides how long the cache lives.
+    """
+    cache_key = None
+    if cache is not None:
+        cache_key = (tuple((k, tuple(v)) for k, v in groups.items()),
+                     tuple((k, tuple(v)) for k, v in x.items()) if x else None)
+        if cache_key in cache:
+            return cache[cache_key]
+
+    import scipy.stats as stats # deferred, so importing this module stays cheap
+    keys = list(groups)
+    values, n = _padded([groups[k] for k in keys])
+    mean = np.nansum(values, axis=1) / n
+    std = np.sqrt(np.nansum((values - mean[:, None])**2, axis=1) / n)
+    dof = n - 1
+    columns = dict(n=n, mean=mean, std=std, dof=dof, ci=stats.t.ppf(0.95, dof) * std)
+    if x:
+        x_values, x_n = _padded([x[k] for k in keys])
+        columns['x_mean'] = np.nansum(x_values, axis=1) / x_n
+    table = GroupTable(keys, **columns)
+    if cache is not None:
+        cache[cache_key] = table
+    return table
+
+
+def paired_ttests(groups, pairs):
+    """
+    Two-sided paired t-test p-values for each (key_a, key_b) in pairs. Pairs of groups with the same
+    size are tested together in one call.
+    """
+    import scipy.stats as stats
+    p_values = np.full(len(pairs), np.nan)
+    by_size = {}
+    for i, (a, b) in enumerate(pairs):
+        by_size.setdefault(len(groups[a]), []).append(i)
+    for size, indices in by_size.items():
+        a = np.array([groups[pairs[i][0]] for i in indices], dtype=np.float64)
+        b = np.array([groups[pairs[i][1]] for i in indices], dtype=np.float64)
+        p_values[indices] = stats.ttest_rel(a, b, axis=1, alternative='two-sided')[1]
+    return p_values
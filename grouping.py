@@ -0,0 +1,74 @@
+#!/usr/local/bin/python3.7
+"""
+Grouping of experiments by the levels encoded in their binder names (e.g. 'pvp-40k-low-u-high-y').
+A level is a list of alternatives, and an experiment is in it when its binder name contains any of them.
+
+Many experiments share a binder, so the index works on the distinct binder names: each term is checked
+against each distinct name once, giving the set of experiments that contain it. Groups for any
+combination of levels are then intersections of those sets. (Splitting names into '-' tokens would
+change the substring matching the plots rely on, e.g. '-low' or '10k' inside '110k'.)
+"""
+
+
+def group_key(*levels):
+    """
+    Stable, collision-free key for a combination of levels, e.g. group_key(['low-u'], ['40k', '10k']).
+    Levels may be nested lists, as in doeMeanPlot.
+    """
+    def freeze(level):
+        if isinstance(level, (list, tuple)):
+            return tuple(freeze(l) for l in level)
+        return level
+    return freeze(levels)
+
+
+class GroupIndex():
+
+    def __init__(self, experiments):
+        self.experiments = list(experiments)
+        self._by_name = {} # binder name -> positions of its experiments
+        for i, e in enumerate(self.experiments):
+            self._by_name.setdefault(e.binder['name'], set()).add(i)
+        self._terms = {}
+
+    def matching(self, term):
+        """
+        Positions of the experiments whose binder name contains term.
+        """
+        if term not in self._terms:
+            positions = set()
+            for name, members in self._by_name.items():
+                if term in name:
+                    positions |= members
+            self._terms[term] = frozenset(positions)
+        return self._terms[term]
+
+    def positions(self, *levels):
+        result = None
+        for level in levels:
+            in_level = set()
+            for term in level:
+                in_level |= self.matching(term)
+            result = in_level if result is None else result & in_level
+        return sorted(result or ())
+
+    def group(self, *levels):
+        """
+        The experiments that are in all of the given levels, in their original order.
+        """
+        return [self.experiments[i] for i in self.positions(*levels)]
+
+    def split(self, xlevels, sublevels):
+        """
+        Split the experiments into every xlevel/sublevel combination. Returns (series, real_data), two dicts
+        keyed by group_key(x, s) with the absorbance times and the experiments of each non-empty group.
+        """
+        series = {}
+        real_data = {}
+        for x in xlevels:
+            for s in sublevels:
+                members = self.group(x, s)
+                if members:
+                    real_data[group_key(x, s)] = members
+                    series[group_key(x, s)] = [d.absorbance_time for d in members]
+        return series, real_data
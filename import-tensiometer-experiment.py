@@ -5,57 +5,89 @@ Import a text-file describing a tensiometer experiment into my sqlite database f
 
 import sys
 import os
-import sqlite3
-import csv
+import importer
+import profiling
+import db
+
+
+def open_database(database_file):
+    if os.path.exists(database_file):
+        return db.connect(database_file)
+    print('Database file could not be found.')
+    sys.exit(1)
+
+
+def batch_main(args, options):
+    """
+    Import every experiment in a directory (using sidecar .json metadata) or listed in a manifest.
+    Files that were already imported are skipped, so this can be re-run over a growing folder.
+    """
+    if len(args) < 4:
+        print('usage: import-tensiometer-experiment.py --batch /path/to/data.db /path/to/directory-or-manifest.tsv [workers]')
+        sys.exit(1)
+
+    conn = open_database(args[2])
+    source = args[3]
+    workers = int(args[4]) if len(args) > 4 else None
+
+    if os.path.isdir(source):
+        entries = importer.scan_directory(source)
+    elif os.path.exists(source):
+        entries = importer.read_manifest(source)
+    else:
+        print('Directory or manifest not found.')
+        sys.exit(1)
+
+    imported = importer.import_batch(conn, entries, workers)
+    print("Imported {} new experiment(s), {} already in the database or skipped".format(
+        len(imported), len(entries) - len(imported)), file=sys.stderr)
+    profiling.finish(options)
 
 
 def main():
-    args = sys.argv
+    args, options = profiling.from_argv(sys.argv)
+
+    if len(args) > 1 and args[1] == '--batch':
+        batch_main(args, options)
+        return
 
     if len(args) < 7:
         print('usage: import-tensiometer-experiment.py /path/to/data.db /path/to/experiment.txt binderid "ISO-8601 date" initialDropVolume[ul] fps')
+        print('       import-tensiometer-experiment.py --batch /path/to/data.db /path/to/directory-or-manifest.tsv [workers]')
+        print('options: --profile, --profile-json FILE, --cprofile STAGE, --cprofile-output FILE')
         sys.exit(1)
     
-    database_file = sys.argv[1]
-    experiment_file = sys.argv[2]
-    binderID = sys.argv[3]
-    exptDate = sys.argv[4]
-    dropVol = sys.argv[5]
-    fps = sys.argv[6]
+    database_file = args[1]
+    experiment_file = args[2]
+    binderID = args[3]
+    exptDate = args[4]
+    dropVol = args[5]
+    fps = args[6]
 
-    if os.path.exists(database_file):
-        conn = sqlite3.connect(database_file)
-        c = conn.cursor()
-    else:
-        print('Database file could not be found.')
-        sys.exit(1)
+    conn = open_database(database_file)
     
     if not os.path.exists(experiment_file):
         print('Experiment file not found.')
         sys.exit(1)
 
     # Go ahead an create the experiment. Assume that the date is well-formatted, do check that the binderid exists though
-    c.execute("SELECT 1 FROM binders WHERE binder_id=?;", [binderID])
-    if not c.fetchone():
+    if not importer.binder_exists(conn, binderID):
         print("binderid could not be found in database")
         sys.exit(1)
 
-    c.execute("INSERT into tensiometer_experiments (binder,date,volume,fps) values (?, ?, ?, ?);", (binderID, exptDate, dropVol, fps))
-    experimentID = c.lastrowid
+    importer.ensure_schema(conn)
+    sha256 = importer.file_hash(experiment_file)
+    existing = importer.imported_experiment(conn, sha256)
+    if existing is not None:
+        print("This file was already imported as experiment {}".format(existing))
+        sys.exit(1)
 
     # Now the tricky part, insert the data that corresponds to the experiment
-    with open(experiment_file) as csvfile:
-        csvreader = csv.reader(csvfile, delimiter='\t')
-        next(csvreader) # all the files have a header row
-        for row in csvreader:
-            c.execute("INSERT into tensiometer_data (tens_exp_id, run_no, age, ca_left, ca_avg, ca_right, ift, ift_err, height, bd, vol) values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);", (experimentID, row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], row[8], row[9]))
-    
-    conn.commit()
-    
-
-
-    
-
+    with profiling.stage('import'):
+        experimentID, n_rows, elapsed = importer.import_experiment(conn, experiment_file, binderID, exptDate, dropVol, fps, sha256=sha256)
+    importer.report(experiment_file, experimentID, n_rows, elapsed)
+    profiling.experiment_time(experimentID, elapsed)
+    profiling.finish(options)
 
 
 # Main body
@@ -0,0 +1,282 @@
+#!/usr/local/bin/python3.7
+"""
+Streaming import of tensiometer experiment files into the sqlite database. Rows are parsed into
+typed values and written in chunks, all inside one transaction, so memory use stays flat no matter
+how long the experiment file is.
+"""
+
+import sys
+import os
+import csv
+import json
+import time
+import hashlib
+import profiling
+import summary
+
+CHUNK_SIZE = 5000
+
+# Pragmas that are safe for the length of a bulk load. The data is only committed at the end,
+# so a crash part-way through leaves the database as it was before the import.
+LOAD_PRAGMAS = {
+    'synchronous': 'OFF',
+    'temp_store': 'MEMORY',
+    'cache_size': '-65536',  # 64 MiB
+}
+
+# Column order in the tensiometer export files
+DATA_COLUMNS = ('run_no', 'age', 'ca_left', 'ca_avg', 'ca_right', 'ift', 'ift_err', 'height', 'bd', 'vol')
+
+INSERT_DATA = '''INSERT into tensiometer_data (tens_exp_id, run_no, age, ca_left, ca_avg, ca_right, ift, ift_err, height, bd, vol)
+                 values (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);'''
+
+
+def parse_row(row):
+    """
+    Convert one row of the tab-separated export into typed values.
+    """
+    if len(row) < len(DATA_COLUMNS):
+        raise ValueError("expected {} columns, got {}".format(len(DATA_COLUMNS), len(row)))
+    return (int(row[0]),) + tuple(float(v) for v in row[1:len(DATA_COLUMNS)])
+
+
+def read_chunks(experiment_file, chunk_size=CHUNK_SIZE):
+    """
+    Yield lists of at most chunk_size parsed rows from an experiment file.
+    """
+    with open(experiment_file, newline='') as csvfile:
+        csvreader = csv.reader(csvfile, delimiter='\t')
+        next(csvreader) # all the files have a header row
+        chunk = []
+        for line_no, row in enumerate(csvreader, start=2):
+            if not row:
+                continue
+            try:
+                chunk.append(parse_row(row))
+            except ValueError as err:
+                raise ValueError("{}, line {}: {}".format(experiment_file, line_no, err))
+            if len(chunk) >= chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+
+def set_pragmas(conn, pragmas):
+    """
+    Apply the given pragmas and return their previous values, so they can be restored.
+    """
+    previous = {}
+    for name, value in pragmas.items():
+        previous[name] = conn.execute('PRAGMA {};'.format(name)).fetchone()[0]
+        conn.execute('PRAGMA {} = {};'.format(name, value))
+    return previous
+
+
+def binder_exists(conn, binderID):
+    return conn.execute("SELECT 1 FROM binders WHERE binder_id=?;", [binderID]).fetchone() is not None
+
+
+def ensure_schema(conn):
+    """
+    Create the table that records which files have already been imported, keyed by content hash.
+    """
+    conn.execute('''CREATE TABLE IF NOT EXISTS imported_files (sha256 TEXT PRIMARY KEY,
+                    tens_exp_id INTEGER, filename TEXT, imported_at TEXT);''')
+    conn.commit()
+
+
+def file_hash(experiment_file):
+    h = hashlib.sha256()
+    with open(experiment_file, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def imported_experiment(conn, sha256):
+    """
+    Return the tens_exp_id a file with this content hash was imported as, or None.
+    """
+    row = conn.execute('SELECT tens_exp_id FROM imported_files WHERE sha256 = ?;', [sha256]).fetchone()
+    return row[0] if row else None
+
+
+def write_experiment(conn, chunks, binderID, exptDate, dropVol, fps, experiment_file=None, sha256=None):
+    """
+    Create the experiment and write its data chunks into the database in a single transaction, along
+    with its row in tensiometer_summary. Returns (experimentID, number of rows, elapsed seconds).
+    """
+    start = time.perf_counter()
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None # we manage the transaction ourselves
+    previous = set_pragmas(conn, LOAD_PRAGMAS)
+    summary.ensure_table(conn)
+    c = conn.cursor()
+    n_rows = 0
+    facts = summary.Accumulator()
+    try:
+        c.execute('BEGIN;')
+        c.execute("INSERT into tensiometer_experiments (binder,date,volume,fps) values (?, ?, ?, ?);", (binderID, exptDate, dropVol, fps))
+        experimentID = c.lastrowid
+        for chunk in chunks:
+            c.executemany(INSERT_DATA, [(experimentID,) + row for row in chunk])
+            facts.add(chunk)
+            n_rows += len(chunk)
+        facts.write(c, experimentID)
+        if sha256:
+            c.execute("INSERT into imported_files (sha256, tens_exp_id, filename, imported_at) values (?, ?, ?, datetime('now'));",
+                      (sha256, experimentID, experiment_file))
+        c.execute('COMMIT;')
+    except BaseException:
+        c.execute('ROLLBACK;')
+        raise
+    finally:
+        set_pragmas(conn, previous)
+        conn.isolation_level = isolation_level
+    return experimentID, n_rows, time.perf_counter() - start
+
+
+def import_experiment(conn, experiment_file, binderID, exptDate, dropVol, fps, chunk_size=CHUNK_SIZE, sha256=None):
+    """
+    Stream one experiment file into the database. See write_experiment.
+    """
+    return write_experiment(conn, read_chunks(experiment_file, chunk_size), binderID, exptDate, dropVol, fps,
+                            experiment_file=experiment_file, sha256=sha256)
+
+
+def report(experiment_file, experimentID, n_rows, elapsed):
+    rate = n_rows / elapsed if elapsed > 0 else float('inf')
+    print("Imported {} as experiment {}: {} rows in {:.2f} s ({:.0f} rows/s)".format(
+        experiment_file, experimentID, n_rows, elapsed, rate), file=sys.stderr)
+
+
+def read_manifest(manifest_file):
+    """
+    Read a tab-separated manifest with one experiment per line: file, binderid, date, volume, fps.
+    Relative paths are taken relative to the manifest. Blank lines and lines starting with # are ignored.
+    """
+    base = os.path.dirname(os.path.abspath(manifest_file))
+    entries = []
+    with open(manifest_file, newline='') as f:
+        for line_no, row in enumerate(csv.reader(f, delimiter='\t'), start=1):
+            if not row or row[0].startswith('#') or (line_no == 1 and row[0] == 'file'):
+                continue
+            if len(row) < 5:
+                raise ValueError("{}, line {}: expected file, binderid, date, volume, fps".format(manifest_file, line_no))
+            entries.append((os.path.join(base, row[0]),) + tuple(v.strip() for v in row[1:5]))
+    return entries
+
+
+def read_sidecar(experiment_file):
+    """
+    Read the metadata for experiment.txt from experiment.json next to it, or return None if there isn't one.
+    The sidecar holds the same values as the command line: binder, date, volume and fps. Raises ValueError
+    if it isn't valid JSON or is missing one of them.
+    """
+    sidecar = os.path.splitext(experiment_file)[0] + '.json'
+    if not os.path.exists(sidecar):
+        return None
+    with open(sidecar) as f:
+        meta = json.load(f)
+    if not isinstance(meta, dict):
+        raise ValueError("{}: not a JSON object".format(sidecar))
+    missing = [key for key in ('binder', 'date', 'volume', 'fps') if key not in meta]
+    if missing:
+        raise ValueError("{}: missing {}".format(sidecar, ', '.join(missing)))
+    return (experiment_file, meta['binder'], meta['date'], meta['volume'], meta['fps'])
+
+
+def scan_directory(directory):
+    """
+    Find all the experiment files in a directory that have sidecar metadata.
+    """
+    entries = []
+    for name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, name)
+        if not name.endswith('.txt') or not os.path.isfile(path):
+            continue
+        try:
+            entry = read_sidecar(path)
+        except ValueError as err:
+            # one bad sidecar shouldn't stop the rest of the batch
+            print("Skipping {}, invalid sidecar metadata: {}".format(path, err), file=sys.stderr)
+            continue
+        if entry is None:
+            print("Skipping {}, no sidecar metadata".format(path), file=sys.stderr)
+            continue
+        entries.append(entry)
+    return entries
+
+
+def _hash_entry(entry):
+    """
+    Hash one experiment file in a worker process. Returns (entry, sha256, error).
+    """
+    try:
+        return entry, file_hash(entry[0]), None
+    except OSError as err:
+        return entry, None, str(err)
+
+
+def _parse_entry(entry):
+    """
+    Parse and validate one experiment file in a worker process. Returns (entry, chunks, error).
+    """
+    experiment_file, binderID, exptDate, dropVol, fps = entry
+    try:
+        float(dropVol); float(fps)
+        chunks = list(read_chunks(experiment_file))
+        if not chunks:
+            raise ValueError("{}: no data rows".format(experiment_file))
+    except (ValueError, OSError) as err:
+        return entry, None, str(err)
+    return entry, chunks, None
+
+
+def import_batch(conn, entries, workers=None):
+    """
+    Import many experiment files. Files are hashed and parsed in a process pool, and a single writer
+    (this process) commits each one. Files whose content has already been imported are skipped.
+    Returns the list of new tens_exp_ids.
+    """
+    from concurrent.futures import ProcessPoolExecutor # only needed here, and slow to import
+    ensure_schema(conn)
+    imported = []
+    seen = set()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = []
+        with profiling.stage('hash'):
+            for entry, sha256, error in pool.map(_hash_entry, entries):
+                if error:
+                    # e.g. a manifest line for a missing file, or an inbox file removed since it was listed
+                    print("Skipping {}: {}".format(entry[0], error), file=sys.stderr)
+                    continue
+                existing = imported_experiment(conn, sha256)
+                if existing is not None or sha256 in seen:
+                    print("Skipping {}, already imported{}".format(entry[0],
+                          " as experiment {}".format(existing) if existing is not None else ""), file=sys.stderr)
+                    continue
+                if not binder_exists(conn, entry[1]):
+                    print("Skipping {}, binderid {} could not be found in database".format(entry[0], entry[1]), file=sys.stderr)
+                    continue
+                seen.add(sha256)
+                pending.append((entry, sha256))
+
+        # Parse a few files per worker at a time, so only a bounded number of parsed files is held in memory
+        with profiling.stage('import'):
+            window = 2 * (workers or os.cpu_count() or 1)
+            for i in range(0, len(pending), window):
+                batch = pending[i:i+window]
+                hashes = dict(batch)
+                for entry, chunks, error in pool.map(_parse_entry, [entry for entry, sha256 in batch]):
+                    if error:
+                        print("Skipping {}: {}".format(entry[0], error), file=sys.stderr)
+                        continue
+                    experiment_file, binderID, exptDate, dropVol, fps = entry
+                    experimentID, n_rows, elapsed = write_experiment(conn, chunks, binderID, exptDate, dropVol, fps,
+                                                                     experiment_file=experiment_file, sha256=hashes[entry])
+                    report(experiment_file, experimentID, n_rows, elapsed)
+                    profiling.experiment_time(experimentID, elapsed)
+                    imported.append(experimentID)
+    return imported
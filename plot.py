@@ -5,22 +5,42 @@ Autogenerate the plots for my thesis / article. With this module, I can quickly
 when new data comes in. I can also standardize all the formatting.
 """
 
+import os
+import sys
+import zlib
+import json
+import hashlib
+import inspect
+import argparse
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np 
 import matplotlib.pyplot as plt 
-import sqlite3
-import scipy.stats as stats
 import re
-from exclude import exclusions
+import filters
 from colorhash import ColorHash
 
 import calc_absorbance
+import curve_cache
+import absorbance_cache
+import db
+from grouping import group_key, GroupIndex
+from group_stats import summarize, paired_ttests
+import profiling
 
-def short_hash(string, debug=False):
-    h = str(abs(hash(string)))[0:6]
-    if debug:
-        print(string)
-        print(h)
-    return h
+# Set to False (e.g. by --batch) to only save the figures, without showing them
+show_figures = True
+
+# Precision of the curves (np.float32 with --float32); loaded experiments carry it to the worker processes
+curve_dtype = calc_absorbance.CURVE_DTYPE
+
+def finish(filename=None):
+    """
+    Save the current figure if there is a filename, then show it when running interactively.
+    """
+    if filename:
+        plt.savefig(filename, transparent=True)
+    if show_figures:
+        plt.show()
 
 def format_ttest(value):
     if value < 0.001:
@@ -28,24 +48,16 @@ def format_ttest(value):
     else:
         return '{:.3f}'.format(value)
 
+def index_for(data):
+    """
+    The GroupIndex of a list of experiments: the one set_experiments() built if data is one of the subsets,
+    so the plots of the same subset share it.
+    """
+    index = _indexes.get(id(data))
+    return index if index is not None else GroupIndex(data)
+
 def split_data(data, xlevels, sublevels):
-    series = {}
-    real_data = {}
-    for d in data:
-        for x in xlevels:
-            for xx in x:
-                for s in sublevels:
-                    index = short_hash(str(x)+str(s))
-                    for ss in s:
-                        if not ss in d.binder['name'] or not xx in d.binder['name']:
-                            continue
-                        if index in series:
-                            series[index].append(d.absorbance_time)
-                            real_data[index].append(d)
-                        else:
-                            series[index] = [d.absorbance_time]
-                            real_data[index] = [d]
-    return series, real_data
+    return index_for(data).split(xlevels, sublevels)
 
 def new_scatter_plot(xaxis, data=None, xlevels=[], sublevels=[], log=False, ylabel=None, sublevels_labels=None,
 colours=['#b36c48', '#afb59b', '#816853'], xlabel=None, tie_lines=False, filename="plot.svg", noxzero=False, errorbars=True, extrafilter=None, extra_p_value = False):
@@ -53,65 +65,61 @@ colours=['#b36c48', '#afb59b', '#816853'], xlabel=None, tie_lines=False, filenam
     Scatter plot showing actual values of physical properties in x-axis.
     """
     series, real_data = split_data(data, xlevels, sublevels)
+    group_x = {index: [r.binder[xaxis] for r in real_data[index]] for index in real_data}
 
-    xs = []; ys = []; dof = []; stdev = []
+    # the means with error bars: one per group, or one per extrafilter subset of each group
+    points = {}; points_x = {}
 
     c = 0
     for x in xlevels:
         for s in sublevels:
-            index = short_hash(str(x)+str(s))
+            index = group_key(x, s)
             #plt.boxplot(series[index], positions=[ real_data[index][0].binder[xaxis] ], showfliers=False, notch=False)
-            plt.scatter( [ d.binder[xaxis] for d in real_data[index] ], [ d.absorbance_time for d in real_data[index] ], c=colours[c]+'77', edgecolors=colours[c] )
+            plt.scatter( group_x[index], series[index], c=colours[c]+'77', edgecolors=colours[c] )
             
             if extrafilter:  # e.g.  extrafilter = ['low-y', 'high-y']
                 for f in extrafilter:
                     data_subset = [ r for r in real_data[index] if f in r.binder['name'] ]
-                    data_series = [ r.absorbance_time for r in data_subset ]
-                    data_xs = [ r.binder[xaxis] for r in data_subset ]
-                    xs.append( sum(data_xs) / len(data_xs) )
-                    ys.append( sum(data_series) / len(data_series) )
-                    dof.append( len(data_series) - 1 )
-                    stdev.append( np.std(data_series) )
+                    points[(index, f)] = [ r.absorbance_time for r in data_subset ]
+                    points_x[(index, f)] = [ r.binder[xaxis] for r in data_subset ]
             else:
-                data_xs = [ r.binder[xaxis] for r in real_data[index] ]
-                xs.append( sum(data_xs) / len(data_xs) )
-                ys.append( sum(series[index]) / len(series[index]) )
-                dof.append( len(series[index]) - 1 )
-                stdev.append( np.std(series[index]) )
+                points[index] = series[index]
+                points_x[index] = group_x[index]
 
             c += 1
     
     
-    stdev=np.array(stdev); dof=np.array(dof)
     if errorbars:
-        plt.errorbar(xs, ys, yerr=stats.t.ppf(0.95, dof)*stdev, fmt='none', ecolor='#000000', capsize=3)
+        table = summarize(points, points_x, cache=_tables)
+        plt.errorbar(table['x_mean'], table['mean'], yerr=table['ci'], fmt='none', ecolor='#000000', capsize=3)
     # add lines between the levels
     if tie_lines:
+        groups = summarize(series, group_x, cache=_tables)
         trendlines = [ [] for i in xlevels ]
         for x in xlevels:
             for j,s in enumerate(sublevels):
-                index = short_hash(str(x)+str(s))
-                trendlines[j].append( (sum([r.binder[xaxis] for r in real_data[index]])/len([ r.binder[xaxis] for r in real_data[index]]),
-                    sum(series[index])/len(series[index]), series[index]) )
+                trendlines[j].append( group_key(x, s) )
+        tie_pairs = [ (t[0], t[1]) for t in trendlines if len(t) == 2 ]
+        extra_pairs = [ (trendlines[0][i], trendlines[1][i]) for i in range(2) ] if extra_p_value else []
+        p_values = dict(zip(tie_pairs + extra_pairs, paired_ttests(series, tie_pairs + extra_pairs)))
+
         c = 0
         for t in trendlines:
-            plt.plot([p[0] for p in t], [p[1] for p in t], linewidth=1, linestyle='dashed', c=colours[c])
+            rows = [ groups.row(index) for index in t ]
+            plt.plot([r['x_mean'] for r in rows], [r['mean'] for r in rows], linewidth=1, linestyle='dashed', c=colours[c])
             if len(t) == 2:
-                ttest = format_ttest( stats.ttest_rel(t[0][2], t[1][2], alternative='two-sided')[1] )
-                x_position = (t[1][0] - t[0][0])/2 + t[0][0]
-                y_position = (t[1][1] - t[0][1])/2 + t[0][1] + (plt.ylim()[1] - plt.ylim()[0]) * 0.002
+                ttest = format_ttest( p_values[(t[0], t[1])] )
+                x_position = (rows[1]['x_mean'] - rows[0]['x_mean'])/2 + rows[0]['x_mean']
+                y_position = (rows[1]['mean'] - rows[0]['mean'])/2 + rows[0]['mean'] + (plt.ylim()[1] - plt.ylim()[0]) * 0.002
                 plt.text( x_position, y_position, "p = "+ttest, style='italic', color=colours[c], horizontalalignment='center')
             c += 1
         
         if extra_p_value:
             for i in range(2):
-                ttest = stats.ttest_rel(trendlines[0][i][2], trendlines[1][i][2], alternative='two-sided')[1]
-                if ttest < 0.001:
-                    ttest_text = '{:0.1e}'.format(ttest)
-                else:
-                    ttest_text = '{:.3f}'.format(ttest)
-                x_position = abs(trendlines[0][i][0] - trendlines[1][i][0])/2 + trendlines[0][i][0]
-                y_position = max(trendlines[0][i][2] + trendlines[1][i][2]) * 1.25
+                a, b = trendlines[0][i], trendlines[1][i]
+                ttest_text = format_ttest( p_values[(a, b)] )
+                x_position = abs(groups.row(a)['x_mean'] - groups.row(b)['x_mean'])/2 + groups.row(a)['x_mean']
+                y_position = max(series[a] + series[b]) * 1.25
                 plt.text( x_position, y_position, "p = "+ttest_text, style='italic', color='#333333', horizontalalignment='center')
 
     if ylabel != None:
@@ -133,11 +141,10 @@ colours=['#b36c48', '#afb59b', '#816853'], xlabel=None, tie_lines=False, filenam
             plt.plot([], c=c, marker='o', label=l)
         plt.legend(loc='best', edgecolor="#000000")
 
-    plt.savefig(filename, transparent=True)
-    plt.show()
+    finish(filename)
 
 
-def mainEffectsPlot(data=None, xlevels=[], sublevels=[], xlabels=None, log=False, ylabel=None, sublevels_labels=None, colours=['#b36c48', '#afb59b', '#816853'], boxes=True):
+def mainEffectsPlot(data=None, xlevels=[], sublevels=[], xlabels=None, log=False, ylabel=None, sublevels_labels=None, colours=['#b36c48', '#afb59b', '#816853'], boxes=True, filename=None):
     """
     Create a main effects plot for x levels and s sublevels. The sublevels and xlevels lists are lists of
     lists -- the entries within each represent all the possible options for that sublevel / xlevel.
@@ -155,52 +162,47 @@ def mainEffectsPlot(data=None, xlevels=[], sublevels=[], xlabels=None, log=False
     inter_xlevel_spacing = 1
     inter_sublevel_spacing = 0.30
 
-    xs = []; ys = []; dof = []; stdev = []
-
     series, real_data = split_data(data, xlevels, sublevels)
+    table = summarize(series, cache=_tables)
     
     # add the box plots and the scatter dots to the figure
     i = 0
-    xs = []; ys = []; dof = []; stdev = [] # if not making a box plot
+    positions = {} # if not making a box plot
     for x in xlevels:
         i += inter_xlevel_spacing
         c = 0
         for s in sublevels:
-            index = short_hash(str(x)+str(s))
+            index = group_key(x, s)
             if boxes:
                 b = plt.boxplot(series[index], positions=[i], showfliers=False, notch=True) # don't show outliers, since we include a scatter plot
                 set_box_color(b, colours[c])
                 plt.scatter(np.random.normal( i, 0.04, len(series[index]) ), series[index], c=colours[c], alpha=0.75 )
             else:
-                xs.append(i)
-                ys.append( sum(series[index]) / len(series[index]) )
-                dof.append( len(series[index]) - 1 )
-                stdev.append( np.std(series[index]) )
-                plt.plot(i, sum(series[index])/len(series[index]), marker='o', c=colours[c])
+                positions[index] = i
+                plt.plot(i, table.row(index)['mean'], marker='o', c=colours[c])
             i+= inter_sublevel_spacing
             c += 1
 
     # plot t-test error bars if not doing box plots
     if not boxes:
-        stdev=np.array(stdev); dof=np.array(dof)
-        plt.errorbar(xs, ys, yerr=stats.t.ppf(0.95, dof)*stdev, fmt='none', ecolor='#000000', capsize=3)
+        means = table.select(list(positions))
+        plt.errorbar(list(positions.values()), means['mean'], yerr=means['ci'], fmt='none', ecolor='#000000', capsize=3)
 
         # add lines between the levels
         trendlines = [ [] for i in xlevels ]
-        k = 0
-        for i,x in enumerate(xlevels):
-            k += inter_xlevel_spacing
+        for x in xlevels:
             for j,s in enumerate(sublevels):
-                index = short_hash(str(x)+str(s))
-                trendlines[j].append( (k, sum(series[index])/len(series[index]), series[index]) )
-                k += inter_sublevel_spacing
+                trendlines[j].append( group_key(x, s) )
+        pairs = [ (t[0], t[1]) for t in trendlines if len(t) == 2 ]
+        p_values = dict(zip(pairs, paired_ttests(series, pairs)))
         c = 0
         for t in trendlines:
-            plt.plot([p[0] for p in t], [p[1] for p in t], linewidth=1, c=colours[c])
+            points = [ (positions[index], table.row(index)['mean']) for index in t ]
+            plt.plot([p[0] for p in points], [p[1] for p in points], linewidth=1, c=colours[c])
             if len(t) == 2:
-                ttest = format_ttest( stats.ttest_rel(t[0][2], t[1][2], alternative='two-sided')[1] )
-                x_position = (t[1][0] - t[0][0])/2 + t[0][0]
-                y_position = (t[1][1] - t[0][1])/2 + t[0][1] + (plt.ylim()[1] - plt.ylim()[0]) * 0.1
+                ttest = format_ttest( p_values[(t[0], t[1])] )
+                x_position = (points[1][0] - points[0][0])/2 + points[0][0]
+                y_position = (points[1][1] - points[0][1])/2 + points[0][1] + (plt.ylim()[1] - plt.ylim()[0]) * 0.1
                 plt.text( x_position, y_position, "p = "+ttest, style='italic', color=colours[c], horizontalalignment='center')
             c += 1
 
@@ -229,50 +231,32 @@ def mainEffectsPlot(data=None, xlevels=[], sublevels=[], xlabels=None, log=False
         plt.legend()
 
 
-    plt.show()
+    finish(filename)
     return
 
 
-def doeMeanPlot(data, levels, names, ylabel=None, log=False):
+def doeMeanPlot(data, levels, names, ylabel=None, log=False, filename=None):
     """
     Levels is a list of lists of lists, each inner list contains the levels to split by.
     e.g. levels = [ [[x-low], [x-high]], [[y-low], [y-high]] ]
     """
+    groups = index_for(data)
     series = {}
-    for d in data:
-        for l in levels:
-                for ll in l:
-                    index = short_hash(str(l)+str(ll))
-                    for lll in ll:
-                        if not lll in d.binder['name']:
-                            continue
-                        if index in series:
-                            series[index].append(d.absorbance_time)
-                        else:
-                            series[index] = [d.absorbance_time]
-
-    # add points to the figure
-    i = 0.25
-    x = []
-    y = []
-    dof = []
-    stdev = []
     for l in levels:
         for ll in l:
-            index = short_hash(str(l)+str(ll))
-            x.append(i)
-            y.append( sum(series[index])/len(series[index]) )
-            dof.append( len(series[index]) - 1 )
-            stdev.append( np.std(series[index]) )
-            i += 0.5
+            series[group_key(l, ll)] = [d.absorbance_time for d in groups.group(ll)]
+
+    table = summarize(series, cache=_tables)
+
+    # add points to the figure
+    x = [0.25 + 0.5*n for n in range(len(table))]
+    y = table['mean']
     plt.scatter(x, y, c='#000000')
     for i in range(0, len(y), 2):
         plt.plot([x[i], x[i+1]], [y[i], y[i+1]], linewidth=1, c='#000000')
     
     # https://stackoverflow.com/questions/20033396/how-to-visualize-95-confidence-interval-in-matplotlib
-    stdev=np.array(stdev)   #(Standard Deviations of your data)
-    dof=np.array(dof)
-    plt.errorbar(x, y, yerr=stats.t.ppf(0.95, dof)*stdev, fmt='none', ecolor='#000000', capsize=3)
+    plt.errorbar(x, y, yerr=table['ci'], fmt='none', ecolor='#000000', capsize=3)
 
     ticks = [0.5 + n for n,i in enumerate(levels)]
     plt.xticks(ticks, names)
@@ -285,10 +269,40 @@ def doeMeanPlot(data, levels, names, ylabel=None, log=False):
     if ylabel:
         plt.ylabel(ylabel)
 
-    plt.show()
+    finish(filename)
 
 
-def plotAbsorptionProfiles(experiments, id=False, log=False):
+def decimate(x, y, max_points=2000, log=False):
+    """
+    Shape-preserving downsampling of a curve for drawing. The x range (log-spaced for a log axis) is cut
+    into max_points/4 bins, and only the first, last, lowest and highest point of each bin is kept, so
+    the drawn line looks the same at that resolution. Points with x <= 0 can't be drawn on a log axis
+    and are dropped.
+    """
+    x = np.asarray(x); y = np.asarray(y)
+    if log:
+        x, y = x[x > 0], y[x > 0]
+    if max_points is None or len(x) <= max_points:
+        return x, y
+    if np.any(np.diff(x) < 0):
+        order = np.argsort(x, kind='stable')
+        x, y = x[order], y[order]
+    position = np.log(x) if log else x
+    n_bins = max(max_points // 4, 1)
+    edges = np.linspace(position[0], position[-1], n_bins + 1)
+    bins = np.clip(np.searchsorted(edges, position, side='right') - 1, 0, n_bins - 1)
+    first = np.r_[0, np.flatnonzero(np.diff(bins)) + 1]
+    last = np.r_[first[1:], len(x)] - 1
+    by_bin_then_y = np.lexsort((y, bins))
+    keep = np.unique(np.concatenate((first, last, by_bin_then_y[first], by_bin_then_y[last])))
+    return x[keep], y[keep]
+
+
+def plotAbsorptionProfiles(experiments, id=False, log=False, filename=None, max_points=2000, rasterized=False):
+    """
+    Plot the volume (as a fraction of the initial volume) against time for each experiment. Curves are
+    decimated to max_points (None to draw every sample), and can be rasterized to keep vector files small.
+    """
     plt.yscale('linear')
     if log:
         plt.xscale('log')
@@ -296,115 +310,321 @@ def plotAbsorptionProfiles(experiments, id=False, log=False):
         plt.xscale('linear')
 
     for e in experiments:
+        x, y = decimate(e.x, e.y / np.max(e.y), max_points=max_points, log=log)
         if id:
-            plt.plot(e.x, [i/max(e.y) for i in e.y], color=ColorHash(e.experiment['tens_exp_id']).hex, label=e.experiment['tens_exp_id'])
+            plt.plot(x, y, color=ColorHash(e.experiment['tens_exp_id']).hex, label=e.experiment['tens_exp_id'], rasterized=rasterized)
         else:
-            plt.plot(e.x, [i/max(e.y) for i in e.y], color=ColorHash(e.binder['name']).hex, label=e.binder['name'])
+            plt.plot(x, y, color=ColorHash(e.binder['name']).hex, label=e.binder['name'], rasterized=rasterized)
     
     handles, labels = plt.gca().get_legend_handles_labels()
     by_label = dict(zip(labels, handles))
     plt.legend(by_label.values(), by_label.keys(), fontsize='small')
     plt.ylabel("Fraction of pre-impact volume")
     plt.xlabel("Absorption time (s)")
-    plt.show()
+    finish(filename)
 
-def main():
-    #conn = sqlite3.connect("/usr/home/zbox/syncthing/Synced/2021-maitrise/in-progress/data.sqlite")
-    conn = sqlite3.connect("../data.sqlite")
-    c = conn.cursor()
 
+# Colours, via https://artsexperiments.withgoogle.com/artpalette/
+pvp_40_360_colours = ['#b36c48', '#afb59b', '#816853']
+big_pvp_40_360_colours = ['#56a6dc', '#d2b07f', '#0f217a', '#c88551']
+pvp_and_pva_colours = ['#809564', '#3d4e37', '#56a6dc', '#d2b07f']
+single_colour = ['#000000', '#000000', '#000000']
+lh_mw_colours = ['#454d7d', '#594540', '#c6b165']
+species_colours = ['#314435', '#9a3c34', '#455266']
+
+# The subsets of the experiments that the figures are drawn from
+SUBSETS = {
+    'all': lambda e: True,
+    'pvp_only': lambda e: 'pvp' in e.binder['name'], # PVP-only data
+    'all_binders': lambda e: 'low-y' in e.binder['name'], # Low-y only data
+}
+
+# Plot functions that take the experiments as data=..., the others take them as the first argument
+DATA_KEYWORD = {'new_scatter_plot'}
+
+def figure_jobs():
+    """
+    All the figures, as (subset, plot function name, args, kwargs) jobs. Every job has a filename.
+    """
+    return [
+        # useful for checking a particular binder
+        #('all', 'plotAbsorptionProfiles', ([e for e in experiments if 'pvp-360k-low-u-high' in e.binder['name']],), dict(id=True, log=True)),
+
+        # Global view of all data
+        ('all', 'plotAbsorptionProfiles', (), dict(log=True, filename="profiles-log.svg")),
+        ('all', 'plotAbsorptionProfiles', (), dict(filename="profiles.svg")),
+
+        ('pvp_only', 'new_scatter_plot', ("surface_tension",), dict(xlevels=[['low-y'], ['high-y']], sublevels=[['40k'], ['360k']], xlabel="Surface tension (mN/m)",
+            log=True, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"],
+            colours=['#56a6dc', '#d2b07f', '#56a6dc', '#d2b07f'], tie_lines=True, filename="pvp-surface_tension,all.svg", noxzero=True, errorbars=True, extra_p_value=True)),
+
+        ('pvp_only', 'new_scatter_plot', ("viscosity",), dict(xlevels=[['low-u'], ['high-u']], sublevels=[['40k'], ['360k']], xlabel="Viscosity (Pa s)",
+            log=True, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k, 21 wt-%", "PVP 360k, 4.7 wt-%", "PVP 40k, 36 wt-%", "PVP 360k, 10 wt-%"],
+            colours=big_pvp_40_360_colours, tie_lines=True, extra_p_value=True, filename="pvp-u,all.svg")),
+
+        ('pvp_only', 'new_scatter_plot', ("per_conc",), dict(xlevels=[['low-u'], ['high-u']], sublevels=[['40k'], ['360k']], xlabel="Binder concentration (wt-%)",
+            log=True, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k, 21 wt-%", "PVP 360k, 4.7 wt-%", "PVP 40k, 36 wt-%", "PVP 360k, 10 wt-%"],
+            colours=big_pvp_40_360_colours, tie_lines=False, extra_p_value=True, filename="pvp-conc.svg")),
+
+        ('pvp_only', 'doeMeanPlot', ([[['low-u'], ['high-u']], [['low-y'], ['high-y']], [['40k'], ['360k']]], ['μ', 'γ', 'MW']), dict(ylabel="Absorption time (s)",
+            filename="pvp-doe.svg")),
+
+        ('pvp_only', 'mainEffectsPlot', ([['low-u'], ['high-u']], [['40k'], ['360k']]), dict(xlabels=['Low μ', 'High μ'],
+            log=False, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"], colours=pvp_40_360_colours, boxes=False, filename="pvp-u,mw-means.svg")),
+        ('pvp_only', 'mainEffectsPlot', ([['low-u'], ['high-u']], [['40k'], ['360k']]), dict(xlabels=['Low μ', 'High μ'],
+            log=False, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"], colours=pvp_40_360_colours, boxes=True, filename="pvp-u,mw-boxes.svg")),
+
+        ('pvp_only', 'mainEffectsPlot', ([['low-y'], ['high-y']], [['40k'], ['360k']]), dict(xlabels=['Low γ', 'High γ'],
+            log=False, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"], colours=pvp_40_360_colours, boxes=False, filename="pvp-y,mw-means.svg")),
+        ('pvp_only', 'mainEffectsPlot', ([['low-y'], ['high-y']], [['40k'], ['360k']]), dict(xlabels=['Low γ', 'High γ'],
+            log=False, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"], colours=pvp_40_360_colours, boxes=True, filename="pvp-y,mw-boxes.svg")),
+
+        ('pvp_only', 'mainEffectsPlot', ([['40k'], ['360k']], [['pvp']]), dict(xlabels=['PVP 40k', 'PVP 360k'],
+            ylabel="Absorption time (s)", colours=single_colour, boxes=False, filename="pvp-mw-means.svg")),
+        ('pvp_only', 'mainEffectsPlot', ([['40k'], ['360k']], [['pvp']]), dict(xlabels=['PVP 40k', 'PVP 360k'],
+            ylabel="Absorption time (s)", colours=single_colour, boxes=True, filename="pvp-mw-boxes.svg")),
+
+        ('all_binders', 'new_scatter_plot', ("viscosity",), dict(xlevels=[['pva'], ['pvp']], sublevels=[['40k', '10k'], ['360k', '124k']], xlabel="Viscosity (Pa s)",
+            log=True, ylabel="Absorption time (s)", sublevels_labels=["PVA 10k", "PVA 124k", "PVP 40k", "PVP 360k"],
+            colours=pvp_and_pva_colours, tie_lines=True, extra_p_value=True, filename="pva,pvp-u.svg")),
+
+        ('all_binders', 'new_scatter_plot', ("per_conc",), dict(xlevels=[['pva'], ['pvp']], sublevels=[['40k', '10k'], ['360k', '124k']], extrafilter=['low-u', 'high-u'], xlabel="Binder concentration (wt-%)",
+            log=True, ylabel="Absorption time (s)", sublevels_labels=["PVA 10k", "PVA 124k", "PVP 40k", "PVP 360k"],
+            colours=pvp_and_pva_colours, tie_lines=False, extra_p_value=True, filename="pva,pvp-conc.svg")),
+
+        ('all_binders', 'doeMeanPlot', ([[['low-u'], ['high-u']], [['10k', '40k'], ['124k', '360k']], [['pva'], ['pvp']]], ['μ', 'MW', 'PVA, PVP']), dict(ylabel="Absorption time (s)",
+            filename="pva,pvp-doe.svg")),
+
+        ('all_binders', 'mainEffectsPlot', ([['low-u'], ['high-u']], [['10k', '40k'], ['124k', '360k']]),
+            dict(xlabels=['Low μ', 'High μ'], log=False, ylabel="Absorption time (s)", sublevels_labels=["Low MW", "High MW"], colours=lh_mw_colours, boxes=False, filename="pva,pvp-u,mw-means.svg")),
+        ('all_binders', 'mainEffectsPlot', ([['low-u'], ['high-u']], [['10k', '40k'], ['124k', '360k']]),
+            dict(xlabels=['Low μ', 'High μ'], log=False, ylabel="Absorption time (s)", sublevels_labels=["Low MW", "High MW"], colours=lh_mw_colours, boxes=True, filename="pva,pvp-u,mw-boxes.svg")),
+
+        ('all_binders', 'mainEffectsPlot', ([['10k', '40k'], ['124k', '360k']], [['pva'], ['pvp']]), dict(xlabels=['Low MW', 'High MW'],
+            log=False, ylabel="Absorption time (s)", sublevels_labels=["PVA", "PVP"], colours=species_colours, boxes=False, filename="pva,pvp-mw,species-means.svg")),
+        ('all_binders', 'mainEffectsPlot', ([['10k', '40k'], ['124k', '360k']], [['pva'], ['pvp']]), dict(xlabels=['Low MW', 'High MW'],
+            log=False, ylabel="Absorption time (s)", sublevels_labels=["PVA", "PVP"], colours=species_colours, boxes=True, filename="pva,pvp-mw,species-boxes.svg")),
+
+        ('all_binders', 'mainEffectsPlot', ([['pva'], ['pvp']], [['low-y']]), dict(xlabels=['PVA', 'PVP'], ylabel="Absorption time (s)", colours=single_colour, boxes=False,
+            filename="pva,pvp-species-means.svg")),
+        ('all_binders', 'mainEffectsPlot', ([['pva'], ['pvp']], [['low-y']]), dict(xlabels=['PVA', 'PVP'], ylabel="Absorption time (s)", colours=single_colour, boxes=True,
+            filename="pva,pvp-species-boxes.svg")),
+    ]
+
+
+def load_data(database_file, snapshot=False, conn=None, store=False):
+    """
+    Load the experiments the figures are drawn from, with their absorbance times. The database is only
+    read, so this can run while experiments are being imported; with snapshot, it is read from a copy in memory.
+    Absorbance times come from the absorbance cache where it has them. A caller with a connection of its own
+    can pass it (it is left open), and with store, the times calculated here are saved to the cache.
+    """
+    own_conn = conn is None
+    if own_conn:
+        conn = db.connect(database_file, readonly=True, snapshot=snapshot)
+    try:
+        return _load_data(database_file, conn, store)
+    finally:
+        if own_conn:
+            conn.close()
+
+
+def _load_data(database_file, conn, store):
+    percent_absorbed = 79 # hard-coded for the moment
     experiments = []
 
-    c.execute('''SELECT tens_exp_id, binder, binders.name, date, volume, fps, binders.per_conc,
-                binders.viscosity, binders.surface_tension, binders.smooth_ca, binders.rough_ca,
-                binders.cca_cos_theta, temperature FROM tensiometer_experiments LEFT JOIN binders on
-                tensiometer_experiments.binder = binders.binder_id;''')
+    # get all the experiments for 'low-high' binders, room-temperature only, droplet size in-spec,
+    # skipping 'known-bad' exp_id's -- repeated experiments with better tip size particularly
+    with profiling.stage('select'):
+        selected = [row[0] for row in filters.LOW_HIGH_ROOM_TEMPERATURE.select(conn)]
+
+    # curves come from the memory-mapped cache next to the database, only new or changed ones are read from sqlite
+    with profiling.stage('load'):
+        cache = curve_cache.CurveCache(database_file)
+        loaded = cache.load_experiments(selected, conn, curve_dtype)
+    with profiling.stage('absorbance'):
+        # the curve cache has just fingerprinted the data, the absorbance cache is keyed on the same fingerprints
+        fingerprints = {e.experiment['tens_exp_id']: cache.index[e.experiment['tens_exp_id']][2] for e in loaded}
+        fingerprints = absorbance_cache.with_precision(fingerprints, curve_dtype)
+        cached = absorbance_cache.lookup(conn, percent_absorbed, fingerprints) if absorbance_cache.exists(conn) else {}
+        new_entries = []
+        for e in loaded:
+            tens_exp_id = e.experiment['tens_exp_id']
+            if tens_exp_id in cached:
+                e.absorbance_time, e.extrapolated = cached[tens_exp_id]
+            else:
+                started = profiling.clock()
+                e.calc_absorbance_time(percent_absorbed)
+                profiling.experiment_time(tens_exp_id, profiling.clock() - started)
+                new_entries.append((tens_exp_id, fingerprints[tens_exp_id], e.absorbance_time, e.extrapolated))
+            experiments.append(e)
+        if store and new_entries:
+            absorbance_cache.ensure_cache(conn)
+            absorbance_cache.store(conn, percent_absorbed, new_entries)
+    if profiling.enabled():
+        profiling.experiment_memory(calc_absorbance.memory_usage(experiments))
+    return experiments
+
+
+# Subsets of the experiments in this process, used by render_job, with their group indexes (by id of
+# the subset list) and the group statistics computed from them. All three are replaced by set_experiments.
+_subsets = {}
+_indexes = {}
+_tables = {}
+
+def set_experiments(experiments):
+    _subsets.clear()
+    _indexes.clear()
+    _tables.clear()
+    for name, selected in SUBSETS.items():
+        _subsets[name] = [e for e in experiments if selected(e)]
+        _indexes[id(_subsets[name])] = GroupIndex(_subsets[name])
+
+
+def render_job(job, outdir=None):
+    """
+    Draw one figure job on a fresh figure, and close it afterwards.
+    """
+    subset, function, args, kwargs = job
+    kwargs = dict(kwargs)
+    # reproducible jitter in the box plots, from the figure's own name so it doesn't depend on --outdir
+    np.random.seed(zlib.crc32((kwargs.get('filename') or '').encode()))
+    if outdir and kwargs.get('filename'):
+        kwargs['filename'] = os.path.join(outdir, kwargs['filename'])
+    if function in DATA_KEYWORD:
+        kwargs['data'] = _subsets[subset]
+    else:
+        args = (_subsets[subset],) + tuple(args)
+    globals()[function](*args, **kwargs)
+    plt.close('all')
+    return kwargs.get('filename')
 
-    # get all the experiments for 'low-high' binders, room-temperature only, droplet size in-spec
-    for row in c.fetchall():
-        if not ('-low' in row[2] or '-high' in row[2]) or row[12] > 30:
-            continue
-        if row[0] in exclusions(): # skip 'known-bad' exp_id's -- repeated experiments with better tip size particularly
-            continue
-        #print(row)
-        e = calc_absorbance.getExperiment(row[0], conn.cursor())
-        e.calc_absorbance_time(79) # hard-coded for the moment
-        experiments.append(e)
-
-    # useful for checking a particular binder
-    #plotAbsorptionProfiles([e for e in experiments if 'pvp-360k-low-u-high' in e.binder['name']], id=True, log=True)
-
-    # Global view of all data
-    plotAbsorptionProfiles(experiments, log=True)
-    plotAbsorptionProfiles(experiments)
-
-    # Colours, via https://artsexperiments.withgoogle.com/artpalette/
-    pvp_40_360_colours = ['#b36c48', '#afb59b', '#816853']
-    big_pvp_40_360_colours = ['#56a6dc', '#d2b07f', '#0f217a', '#c88551']
-    pvp_and_pva_colours = ['#809564', '#3d4e37', '#56a6dc', '#d2b07f']
-    single_colour = ['#000000', '#000000', '#000000']
-    lh_mw_colours = ['#454d7d', '#594540', '#c6b165']
-    species_colours = ['#314435', '#9a3c34', '#455266']
-
-    # PVP-only data
-    
-    pvp_only = [e for e in experiments if 'pvp' in e.binder['name']]
 
-    new_scatter_plot("surface_tension", data=pvp_only, xlevels=[['low-y'], ['high-y']], sublevels=[['40k'], ['360k']], xlabel="Surface tension (mN/m)",
-        log=True, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"],
-        colours=['#56a6dc', '#d2b07f', '#56a6dc', '#d2b07f'], tie_lines=True, filename="pvp-surface_tension,all.svg", noxzero=True, errorbars=True, extra_p_value=True)
+def _init_worker(experiments):
+    global show_figures
+    show_figures = False
+    plt.switch_backend('Agg')
+    set_experiments(experiments)
 
-    new_scatter_plot("viscosity", data=pvp_only, xlevels=[['low-u'], ['high-u']], sublevels=[['40k'], ['360k']], xlabel="Viscosity (Pa s)",
-        log=True, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k, 21 wt-%", "PVP 360k, 4.7 wt-%", "PVP 40k, 36 wt-%", "PVP 360k, 10 wt-%"],
-        colours=big_pvp_40_360_colours, tie_lines=True, extra_p_value=True, filename="pvp-u,all.svg")
 
-    new_scatter_plot("per_conc", data=pvp_only, xlevels=[['low-u'], ['high-u']], sublevels=[['40k'], ['360k']], xlabel="Binder concentration (wt-%)",
-        log=True, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k, 21 wt-%", "PVP 360k, 4.7 wt-%", "PVP 40k, 36 wt-%", "PVP 360k, 10 wt-%"],
-        colours=big_pvp_40_360_colours, tie_lines=False, extra_p_value=True)
+# Modules whose code the figures depend on: the plot functions and their helpers, the grouping and the statistics
+FIGURE_MODULES = ('plot', 'grouping', 'group_stats')
 
-    doeMeanPlot(pvp_only, [[['low-u'], ['high-u']], [['low-y'], ['high-y']], [['40k'], ['360k']]], ['μ', 'γ', 'MW'], ylabel="Absorption time (s)")
-    
-    mainEffectsPlot(pvp_only, [['low-u'], ['high-u']], [['40k'], ['360k']], xlabels=['Low μ', 'High μ'],
-        log=False, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"], colours=pvp_40_360_colours, boxes=False)
-    mainEffectsPlot(pvp_only, [['low-u'], ['high-u']], [['40k'], ['360k']], xlabels=['Low μ', 'High μ'],
-        log=False, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"], colours=pvp_40_360_colours, boxes=True)
-    
-    mainEffectsPlot(pvp_only, [['low-y'], ['high-y']], [['40k'], ['360k']], xlabels=['Low γ', 'High γ'],
-        log=False, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"], colours=pvp_40_360_colours, boxes=False)
-    mainEffectsPlot(pvp_only, [['low-y'], ['high-y']], [['40k'], ['360k']], xlabels=['Low γ', 'High γ'],
-        log=False, ylabel="Absorption time (s)", sublevels_labels=["PVP 40k", "PVP 360k"], colours=pvp_40_360_colours, boxes=True)
-    
-    mainEffectsPlot(pvp_only, [['40k'], ['360k']], [['pvp']], xlabels=['PVP 40k', 'PVP 360k'],
-        ylabel="Absorption time (s)", colours=single_colour, boxes=False)
-    mainEffectsPlot(pvp_only, [['40k'], ['360k']], [['pvp']], xlabels=['PVP 40k', 'PVP 360k'],
-        ylabel="Absorption time (s)", colours=single_colour, boxes=True)
-    
-    # Low-y only data
-    all_binders = [e for e in experiments if 'low-y' in e.binder['name']]
+# Plot functions that draw the curves themselves, not only the absorbance times
+CURVE_FUNCTIONS = {'plotAbsorptionProfiles'}
 
-    new_scatter_plot("viscosity", data=all_binders, xlevels=[['pva'], ['pvp']], sublevels=[['40k', '10k'], ['360k', '124k']], xlabel="Viscosity (Pa s)",
-        log=True, ylabel="Absorption time (s)", sublevels_labels=["PVA 10k", "PVA 124k", "PVP 40k", "PVP 360k"],
-        colours=pvp_and_pva_colours, tie_lines=True, extra_p_value=True, filename="pva,pvp-u.svg")
+_code_fingerprint = None
 
-    new_scatter_plot("per_conc", data=all_binders, xlevels=[['pva'], ['pvp']], sublevels=[['40k', '10k'], ['360k', '124k']], extrafilter=['low-u', 'high-u'], xlabel="Binder concentration (wt-%)",
-        log=True, ylabel="Absorption time (s)", sublevels_labels=["PVA 10k", "PVA 124k", "PVP 40k", "PVP 360k"],
-        colours=pvp_and_pva_colours, tie_lines=False, extra_p_value=True, filename="pva,pvp-conc.svg")
+def code_fingerprint():
+    global _code_fingerprint
+    if _code_fingerprint is None:
+        h = hashlib.sha256()
+        for name in FIGURE_MODULES:
+            module = sys.modules[__name__] if name == 'plot' else __import__(name)
+            h.update(inspect.getsource(module).encode())
+        _code_fingerprint = h.hexdigest()
+    return _code_fingerprint
 
 
-    doeMeanPlot(all_binders, [[['low-u'], ['high-u']], [['10k', '40k'], ['124k', '360k']], [['pva'], ['pvp']]], ['μ', 'MW', 'PVA, PVP'], ylabel="Absorption time (s)")
+def job_fingerprint(job):
+    """
+    Fingerprint everything a figure depends on: the code that draws it, its arguments, the precision of the
+    curves, and the experiment and binder rows and absorbance times of the experiments it draws (with
+    their curves, for the figures that plot them). set_experiments() must have been called.
+    """
+    subset, function, args, kwargs = job
+    h = hashlib.sha256()
+    h.update(code_fingerprint().encode())
+    h.update(repr((subset, function, args, sorted(kwargs.items()), np.dtype(curve_dtype).str)).encode())
+    for e in _subsets[subset]:
+        binder = tuple(e.binder.values()) if e.binder is not None else None
+        h.update(repr((tuple(e.experiment.values()), binder, float(e.absorbance_time))).encode())
+        if function in CURVE_FUNCTIONS:
+            loaded = e.curve_loaded()
+            h.update(np.ascontiguousarray(e.x).tobytes())
+            h.update(np.ascontiguousarray(e.y).tobytes())
+            if not loaded:
+                e.release_curve()
+    return h.hexdigest()
+
+
+def render_all(experiments, jobs, outdir, workers=None, force=False):
+    """
+    Render the jobs headless across a process pool, each one writing its own file. The experiments are
+    sent to each worker once. Figures whose fingerprint matches the one in outdir/figures.json (and whose
+    file still exists) are up to date and skipped, unless force is set. Returns the number of figures
+    that failed to render.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    manifest_file = os.path.join(outdir, 'figures.json')
+    manifest = {}
+    if os.path.exists(manifest_file) and not force:
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    set_experiments(experiments)
+    outdated = []
+    fingerprints = {}
+    for job in jobs:
+        filename = job[3]['filename']
+        fingerprints[filename] = job_fingerprint(job)
+        if manifest.get(filename) == fingerprints[filename] and os.path.exists(os.path.join(outdir, filename)):
+            continue
+        outdated.append(job)
+    print("{} of {} figures are up to date".format(len(jobs) - len(outdated), len(jobs)), file=sys.stderr)
+    if not outdated:
+        return 0
+
+    failed = 0
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(experiments,)) as pool:
+        futures = [pool.submit(render_job, job, outdir) for job in outdated]
+        for job, future in zip(outdated, futures):
+            try:
+                filename = future.result()
+            except Exception as err: # one broken figure shouldn't stop the others; it's retried next time
+                print("Could not render {}: {!r}".format(job[3]['filename'], err), file=sys.stderr)
+                failed += 1
+                continue
+            print("Wrote", filename, file=sys.stderr)
+            manifest[job[3]['filename']] = fingerprints[job[3]['filename']]
+            with open(manifest_file + '.tmp', 'w') as f:
+                json.dump(manifest, f, indent=1, sort_keys=True)
+            os.replace(manifest_file + '.tmp', manifest_file)
+    return failed
 
-    mainEffectsPlot(all_binders, [['low-u'], ['high-u']], [['10k', '40k'], ['124k', '360k']],
-        xlabels=['Low μ', 'High μ'], log=False, ylabel="Absorption time (s)", sublevels_labels=["Low MW", "High MW"], colours=lh_mw_colours, boxes=False)
-    mainEffectsPlot(all_binders, [['low-u'], ['high-u']], [['10k', '40k'], ['124k', '360k']],
-        xlabels=['Low μ', 'High μ'], log=False, ylabel="Absorption time (s)", sublevels_labels=["Low MW", "High MW"], colours=lh_mw_colours, boxes=True)
 
-    mainEffectsPlot(all_binders, [['10k', '40k'], ['124k', '360k']], [['pva'], ['pvp']], xlabels=['Low MW', 'High MW'],
-        log=False, ylabel="Absorption time (s)", sublevels_labels=["PVA", "PVP"], colours=species_colours, boxes=False)
-    mainEffectsPlot(all_binders, [['10k', '40k'], ['124k', '360k']], [['pva'], ['pvp']], xlabels=['Low MW', 'High MW'],
-        log=False, ylabel="Absorption time (s)", sublevels_labels=["PVA", "PVP"], colours=species_colours, boxes=True)
-        
-    mainEffectsPlot(all_binders, [['pva'], ['pvp']], [['low-y']], xlabels=['PVA', 'PVP'], ylabel="Absorption time (s)", colours=single_colour, boxes=False)
-    mainEffectsPlot(all_binders, [['pva'], ['pvp']], [['low-y']], xlabels=['PVA', 'PVP'], ylabel="Absorption time (s)", colours=single_colour, boxes=True)
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    #parser.add_argument('--database', default="/usr/home/zbox/syncthing/Synced/2021-maitrise/in-progress/data.sqlite")
+    parser.add_argument('--database', default="../data.sqlite", help='path to the sqlite database')
+    parser.add_argument('--batch', action='store_true', help="render all the figures to files without showing them, in parallel")
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes for --batch (default: one per core)')
+    parser.add_argument('--outdir', default='.', help='directory for the figure files')
+    parser.add_argument('--force', action='store_true', help='with --batch, re-render figures even if their inputs are unchanged')
+    parser.add_argument('--float32', action='store_true', help='keep the curves in single precision, for half the memory')
+    parser.add_argument('--snapshot', action='store_true', help='copy the database into memory first, instead of reading it in place')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.from_args(args)
+    if args.float32:
+        global curve_dtype
+        curve_dtype = np.float32
+
+    experiments = load_data(args.database, args.snapshot)
+    jobs = figure_jobs()
+
+    failed = 0
+    if args.batch:
+        with profiling.stage('render'):
+            failed = render_all(experiments, jobs, args.outdir, args.jobs, force=args.force)
+    else:
+        set_experiments(experiments)
+        with profiling.stage('render'):
+            for job in jobs:
+                render_job(job, args.outdir)
+    profiling.finish(args)
+    if failed:
+        sys.exit(1)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
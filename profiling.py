@@ -0,0 +1,252 @@
+#!/usr/local/bin/python3.7
+"""
+Stage-level profiling for the scripts (--profile). Records the wall time of each pipeline stage, the number
+of SQL queries, their time and the rows fetched, per-experiment computation times and peak memory, and
+prints them as a table or saves them as JSON. One stage can also be run under cProfile.
+
+Profiling is off unless enable() is called, and then stage() and connect() cost nothing.
+"""
+
+import sys
+import json
+import time
+import sqlite3
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: # not on Windows
+    resource = None
+
+
+class Profile():
+
+    def __init__(self, cprofile_stage=None, cprofile_output=None):
+        self.stages = [] # (name, seconds), in the order they finished
+        self.queries = 0
+        self.query_seconds = 0.0
+        self.rows = 0
+        self.experiments = {} # tens_exp_id -> seconds
+        self.experiment_memory = None # see calc_absorbance.memory_usage
+        self.cprofile_stage = cprofile_stage
+        self.cprofile_output = cprofile_output or '{}.prof'.format(cprofile_stage)
+        self.start = time.perf_counter()
+
+    def peak_memory(self):
+        """
+        Peak resident memory of this process in MiB (ru_maxrss is in KiB on Linux, bytes on macOS).
+        """
+        if resource is None:
+            return None
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return rss / (1024 * 1024) if sys.platform == 'darwin' else rss / 1024
+
+    def summary(self):
+        times = sorted(self.experiments.values())
+        slowest = max(self.experiments, key=self.experiments.get) if self.experiments else None
+        return {
+            'total_seconds': time.perf_counter() - self.start,
+            'stages': [{'stage': name, 'seconds': seconds} for name, seconds in self.stages],
+            'sql': {'queries': self.queries, 'seconds': self.query_seconds, 'rows_fetched': self.rows},
+            'experiments': {'count': len(times), 'total_seconds': sum(times),
+                            'mean_seconds': sum(times) / len(times) if times else None,
+                            'median_seconds': times[len(times) // 2] if times else None,
+                            'max_seconds': times[-1] if times else None, 'slowest': slowest},
+            'peak_memory_mib': self.peak_memory(),
+            'experiment_memory': self.experiment_memory,
+        }
+
+    def report(self, file=sys.stderr):
+        s = self.summary()
+        print("\n{:<24}{:>12}".format('stage', 'seconds'), file=file)
+        for stage in s['stages']:
+            print("{:<24}{:>12.3f}".format(stage['stage'], stage['seconds']), file=file)
+        print("{:<24}{:>12.3f}".format('total', s['total_seconds']), file=file)
+        print("sql: {} queries, {:.3f} s, {} rows fetched".format(s['sql']['queries'], s['sql']['seconds'], s['sql']['rows_fetched']), file=file)
+        e = s['experiments']
+        if e['count']:
+            print("experiments: {} computed in {:.3f} s, mean {:.2e} s, median {:.2e} s, max {:.2e} s (experiment {})".format(
+                e['count'], e['total_seconds'], e['mean_seconds'], e['median_seconds'], e['max_seconds'], e['slowest']), file=file)
+        m = s['experiment_memory']
+        if m and m['count']:
+            print("experiment memory: {} experiments, {:.1f} KiB each (metadata {:.2f} KiB, curve {:.1f} KiB), plus {:.1f} KiB of binder records".format(
+                m['count'], m['bytes_per_experiment'] / 1024, m['metadata_bytes'] / m['count'] / 1024, m['curve_bytes'] / m['count'] / 1024,
+                m['shared_bytes'] / 1024), file=file)
+        if s['peak_memory_mib'] is not None:
+            print("peak memory: {:.1f} MiB".format(s['peak_memory_mib']), file=file)
+
+
+_profile = None
+clock = time.perf_counter
+
+
+def enable(cprofile_stage=None, cprofile_output=None):
+    global _profile
+    _profile = Profile(cprofile_stage, cprofile_output)
+    return _profile
+
+
+def enabled():
+    return _profile is not None
+
+
+@contextmanager
+def stage(name):
+    """
+    Time a stage of the pipeline (a no-op unless profiling is enabled).
+    """
+    if _profile is None:
+        yield
+        return
+    profiler = None
+    if _profile.cprofile_stage == name:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        _profile.stages.append((name, time.perf_counter() - start))
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(_profile.cprofile_output)
+            print("Wrote cProfile stats for stage {} to {}".format(name, _profile.cprofile_output), file=sys.stderr)
+
+
+def experiment_time(tens_exp_id, seconds):
+    if _profile is not None:
+        _profile.experiments[tens_exp_id] = _profile.experiments.get(tens_exp_id, 0) + seconds
+
+
+def experiment_memory(usage):
+    """
+    Record the memory held by the experiments in memory (calc_absorbance.memory_usage).
+    """
+    if _profile is not None:
+        _profile.experiment_memory = usage
+
+
+class ProfilingCursor(sqlite3.Cursor):
+    """
+    Cursor that counts the queries, the time spent in sqlite (executing and fetching) and the rows fetched.
+    """
+
+    def _timed(self, method, *args):
+        start = time.perf_counter()
+        try:
+            return method(self, *args)
+        finally:
+            _profile.query_seconds += time.perf_counter() - start
+
+    def execute(self, *args):
+        _profile.queries += 1
+        return self._timed(sqlite3.Cursor.execute, *args)
+
+    def executemany(self, *args):
+        _profile.queries += 1
+        return self._timed(sqlite3.Cursor.executemany, *args)
+
+    def executescript(self, *args):
+        _profile.queries += 1
+        return self._timed(sqlite3.Cursor.executescript, *args)
+
+    def fetchone(self):
+        row = self._timed(sqlite3.Cursor.fetchone)
+        _profile.rows += row is not None
+        return row
+
+    def fetchmany(self, *args):
+        rows = self._timed(sqlite3.Cursor.fetchmany, *args)
+        _profile.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self._timed(sqlite3.Cursor.fetchall)
+        _profile.rows += len(rows)
+        return rows
+
+    def __next__(self):
+        # called for every row, so inlined rather than going through _timed
+        start = clock()
+        try:
+            row = sqlite3.Cursor.__next__(self)
+        finally:
+            _profile.query_seconds += clock() - start
+        _profile.rows += 1
+        return row
+
+
+class ProfilingConnection(sqlite3.Connection):
+
+    def cursor(self, factory=ProfilingCursor):
+        return super().cursor(factory)
+
+    # the shortcut methods on the connection don't go through cursor(), so route them explicitly
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def executescript(self, *args):
+        return self.cursor().executescript(*args)
+
+
+def connect(database, **kwargs):
+    """
+    sqlite3.connect, with query accounting when profiling is enabled.
+    """
+    if _profile is not None:
+        kwargs.setdefault('factory', ProfilingConnection)
+    return sqlite3.connect(database, **kwargs)
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', action='store_true', help='print the time spent in each stage, SQL and memory use')
+    parser.add_argument('--profile-json', metavar='FILE', help='save the profile as JSON (implies --profile)')
+    parser.add_argument('--cprofile', metavar='STAGE', help='run this stage under cProfile (implies --profile)')
+    parser.add_argument('--cprofile-output', metavar='FILE', help='where to save the cProfile stats (default: STAGE.prof)')
+
+
+def from_args(args):
+    """
+    Enable profiling if any of the add_arguments options were given.
+    """
+    if args.profile or args.profile_json or args.cprofile:
+        enable(args.cprofile, args.cprofile_output)
+
+
+def from_argv(argv):
+    """
+    For scripts without argparse: take the profiling options out of argv, enable profiling if asked,
+    and return the remaining arguments.
+    """
+    remaining = []
+    options = {'--profile': False, '--profile-json': None, '--cprofile': None, '--cprofile-output': None}
+    args = iter(argv)
+    for arg in args:
+        if arg == '--profile':
+            options[arg] = True
+        elif arg in options:
+            options[arg] = next(args, None)
+        else:
+            remaining.append(arg)
+    class Options: pass
+    parsed = Options()
+    parsed.profile, parsed.profile_json = options['--profile'], options['--profile-json']
+    parsed.cprofile, parsed.cprofile_output = options['--cprofile'], options['--cprofile-output']
+    from_args(parsed)
+    return remaining, parsed
+
+
+def finish(args):
+    """
+    Print the profile and save it as JSON if asked.
+    """
+    if _profile is None:
+        return
+    _profile.report()
+    if args.profile_json:
+        with open(args.profile_json, 'w') as f:
+            json.dump(_profile.summary(), f, indent=1)
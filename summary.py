@@ -0,0 +1,164 @@
+#!/usr/local/bin/python3.7
+"""
+Per-experiment summary of the curve data (tensiometer_summary), so that simple facts about a curve
+can be answered without reading it: the number of points, the first and last age, the volume range,
+and the first and last volume of the points used for interpolation (positive time and volume), which
+decide whether a target volume needs extrapolating.
+
+The importer writes the summary in the same transaction as the data. Any other change to an experiment's
+data drops its summary row (through triggers on tensiometer_data), and experiments without one, such as
+those imported before the table existed, are summarized again by ensure_summary().
+"""
+
+import sys
+import sqlite3
+
+# Row layout of the export files after importer.parse_row
+AGE, VOL = 1, 9
+
+COLUMNS = ('tens_exp_id', 'n_points', 'initial_age', 'last_age', 'first_vol', 'last_vol', 'min_vol', 'max_vol',
+           'first_usable_vol', 'last_usable_vol')
+
+
+SCHEMA = (
+    ('tensiometer_summary', '''CREATE TABLE tensiometer_summary (tens_exp_id INTEGER PRIMARY KEY, n_points INTEGER,
+                               initial_age REAL, last_age REAL, first_vol REAL, last_vol REAL, min_vol REAL, max_vol REAL,
+                               first_usable_vol REAL, last_usable_vol REAL);'''),
+    # invalidating is a primary-key delete per row, recomputing every row would make an import quadratic
+    ('tensiometer_summary_insert', '''CREATE TRIGGER tensiometer_summary_insert AFTER INSERT ON tensiometer_data BEGIN
+                                      DELETE FROM tensiometer_summary WHERE tens_exp_id = NEW.tens_exp_id; END;'''),
+    ('tensiometer_summary_update', '''CREATE TRIGGER tensiometer_summary_update AFTER UPDATE ON tensiometer_data BEGIN
+                                      DELETE FROM tensiometer_summary WHERE tens_exp_id IN (OLD.tens_exp_id, NEW.tens_exp_id); END;'''),
+    ('tensiometer_summary_delete', '''CREATE TRIGGER tensiometer_summary_delete AFTER DELETE ON tensiometer_data BEGIN
+                                      DELETE FROM tensiometer_summary WHERE tens_exp_id = OLD.tens_exp_id; END;'''),
+)
+
+
+# The columns the filters use, computed from the data itself, for when the summary can't be brought up to
+# date (a read-only database without the table, or with rows dropped by the triggers). Every curve is read.
+FROM_DATA = '''(SELECT tens_exp_id, n_points,
+                  (SELECT vol FROM tensiometer_data d WHERE d.tens_exp_id = s.tens_exp_id
+                   AND d.age > s.initial_age AND d.vol > 0 ORDER BY d.rowid LIMIT 1) AS first_usable_vol,
+                  (SELECT vol FROM tensiometer_data d WHERE d.tens_exp_id = s.tens_exp_id
+                   AND d.age > s.initial_age AND d.vol > 0 ORDER BY d.rowid DESC LIMIT 1) AS last_usable_vol
+                  FROM (SELECT tens_exp_id, count(*) AS n_points,
+                        (SELECT age FROM tensiometer_data d WHERE d.tens_exp_id = g.tens_exp_id ORDER BY d.rowid LIMIT 1) AS initial_age
+                        FROM tensiometer_data g GROUP BY tens_exp_id) s)'''
+
+
+def ensure_table(conn):
+    """
+    Create the summary table and its triggers, the ones that don't exist yet (so that nothing is written
+    when they all do, e.g. on a read-only connection).
+    """
+    existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE name LIKE 'tensiometer_summary%';")}
+    for name, sql in SCHEMA:
+        if name not in existing:
+            conn.execute(sql)
+
+
+def ensure_summary(conn):
+    """
+    Create the summary table if needed and backfill it for experiments that have data but no summary.
+    Returns False if that wasn't possible (e.g. a read-only database without the table).
+    """
+    try:
+        ensure_table(conn)
+        backfill(conn)
+        conn.commit()
+        return True
+    except sqlite3.OperationalError as err:
+        print("Could not update tensiometer_summary: {}".format(err), file=sys.stderr)
+        return False
+
+
+def backfill(conn):
+    """
+    Summarize, in SQL, the experiments that have data but no summary row. Returns how many there were.
+    """
+    c = conn.cursor()
+    # starting from the experiments keeps this cheap when there's nothing to do: experiments without
+    # data (which never get a row) are looked up in the index rather than by scanning all the data.
+    # Nothing is written then, so an up-to-date summary also works on a read-only connection.
+    missing = '''SELECT tens_exp_id FROM tensiometer_experiments WHERE tens_exp_id NOT IN (SELECT tens_exp_id FROM tensiometer_summary)
+                 AND EXISTS (SELECT 1 FROM tensiometer_data WHERE tensiometer_data.tens_exp_id = tensiometer_experiments.tens_exp_id)'''
+    if c.execute(missing + ' LIMIT 1;').fetchone() is None:
+        return 0
+    c.execute('''INSERT INTO tensiometer_summary (tens_exp_id, n_points, min_vol, max_vol)
+                 SELECT tens_exp_id, count(*), min(vol), max(vol) FROM tensiometer_data
+                 WHERE tens_exp_id IN (''' + missing + ''') GROUP BY tens_exp_id;''')
+    n = c.rowcount
+    # the first and last rows, in import order (the index on tens_exp_id keeps these lookups short)
+    c.execute('''UPDATE tensiometer_summary SET
+                 initial_age = (SELECT age FROM tensiometer_data d WHERE d.tens_exp_id = tensiometer_summary.tens_exp_id ORDER BY d.rowid LIMIT 1),
+                 first_vol = (SELECT vol FROM tensiometer_data d WHERE d.tens_exp_id = tensiometer_summary.tens_exp_id ORDER BY d.rowid LIMIT 1),
+                 last_age = (SELECT age FROM tensiometer_data d WHERE d.tens_exp_id = tensiometer_summary.tens_exp_id ORDER BY d.rowid DESC LIMIT 1),
+                 last_vol = (SELECT vol FROM tensiometer_data d WHERE d.tens_exp_id = tensiometer_summary.tens_exp_id ORDER BY d.rowid DESC LIMIT 1)
+                 WHERE initial_age IS NULL;''')
+    c.execute('''UPDATE tensiometer_summary SET
+                 first_usable_vol = (SELECT vol FROM tensiometer_data d WHERE d.tens_exp_id = tensiometer_summary.tens_exp_id
+                                     AND d.age > tensiometer_summary.initial_age AND d.vol > 0 ORDER BY d.rowid LIMIT 1),
+                 last_usable_vol = (SELECT vol FROM tensiometer_data d WHERE d.tens_exp_id = tensiometer_summary.tens_exp_id
+                                    AND d.age > tensiometer_summary.initial_age AND d.vol > 0 ORDER BY d.rowid DESC LIMIT 1)
+                 WHERE first_usable_vol IS NULL;''')
+    print("Summarized {} experiment(s) in tensiometer_summary".format(n), file=sys.stderr)
+    return n
+
+
+class Accumulator():
+    """
+    Builds the summary of one experiment from its parsed rows as they stream past during an import.
+    """
+
+    def __init__(self):
+        self.n_points = 0
+        self.initial_age = self.last_age = self.first_vol = self.last_vol = None
+        self.min_vol = self.max_vol = self.first_usable_vol = self.last_usable_vol = None
+
+    def add(self, chunk):
+        if not chunk:
+            return
+        if self.n_points == 0:
+            self.initial_age, self.first_vol = chunk[0][AGE], chunk[0][VOL]
+            self.min_vol = self.max_vol = chunk[0][VOL]
+        vols = [row[VOL] for row in chunk]
+        self.min_vol = min(self.min_vol, min(vols))
+        self.max_vol = max(self.max_vol, max(vols))
+        usable = [row[VOL] for row in chunk if row[AGE] > self.initial_age and row[VOL] > 0]
+        if usable:
+            if self.first_usable_vol is None:
+                self.first_usable_vol = usable[0]
+            self.last_usable_vol = usable[-1]
+        self.last_age, self.last_vol = chunk[-1][AGE], chunk[-1][VOL]
+        self.n_points += len(chunk)
+
+    def write(self, cursor, tens_exp_id):
+        if self.n_points == 0:
+            return
+        cursor.execute('INSERT OR REPLACE INTO tensiometer_summary ({}) VALUES ({});'.format(', '.join(COLUMNS), ', '.join('?' * len(COLUMNS))),
+                       (tens_exp_id, self.n_points, self.initial_age, self.last_age, self.first_vol, self.last_vol,
+                        self.min_vol, self.max_vol, self.first_usable_vol, self.last_usable_vol))
+
+
+def source(conn):
+    """
+    What to select the summary columns from: tensiometer_summary once it's up to date, or FROM_DATA if
+    it can't be (so that experiments whose rows are missing aren't silently left out).
+    """
+    if ensure_summary(conn):
+        return 'tensiometer_summary'
+    print("Reading the summary from the curve data instead, which is slower", file=sys.stderr)
+    return FROM_DATA
+
+
+def with_data(conn, tens_exp_ids):
+    """
+    The given experiments that have curve data. The summary is brought up to date first; if it can't be
+    (a read-only database), the data is asked instead.
+    """
+    wanted = set(tens_exp_ids)
+    if ensure_summary(conn):
+        c = conn.execute('SELECT tens_exp_id FROM tensiometer_summary WHERE n_points > 0;')
+    else:
+        c = conn.execute('SELECT DISTINCT tens_exp_id FROM tensiometer_data;')
+    return {row[0] for row in c if row[0] in wanted}
@@ -0,0 +1,102 @@
+#!/usr/local/bin/python3.7
+"""
+Generate a synthetic experiments database (binders, tensiometer_experiments, tensiometer_data) with
+realistic decaying drop-volume curves, for benchmarking and for trying out the scripts without the real data.
+"""
+
+import sys
+import os
+import sqlite3
+import numpy as np
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS binders (binder_id INTEGER PRIMARY KEY, name TEXT, per_conc REAL, viscosity REAL,
+    surface_tension REAL, smooth_ca REAL, rough_ca REAL, cca_cos_theta REAL);
+CREATE TABLE IF NOT EXISTS tensiometer_experiments (tens_exp_id INTEGER PRIMARY KEY, binder INTEGER REFERENCES binders,
+    date TEXT, volume REAL, fps REAL, temperature REAL DEFAULT 22);
+CREATE TABLE IF NOT EXISTS tensiometer_data (tens_exp_id INTEGER REFERENCES tensiometer_experiments, run_no INTEGER,
+    age REAL, ca_left REAL, ca_avg REAL, ca_right REAL, ift REAL, ift_err REAL, height REAL, bd REAL, vol REAL);
+'''
+
+# The binder design used for the thesis: species and molecular weight, crossed with low/high viscosity and surface tension
+SPECIES = {'pvp': ('40k', '360k'), 'pva': ('10k', '124k')}
+LEVELS = [(u, y) for u in ('low-u', 'high-u') for y in ('low-y', 'high-y')]
+
+HEADER = 'run_no\tage\tca_left\tca_avg\tca_right\tift\tift_err\theight\tbd\tvol\n'
+
+
+def binder_rows(rng):
+    rows = []
+    for species, weights in SPECIES.items():
+        for weight in weights:
+            for u, y in LEVELS:
+                rows.append((len(rows) + 1, '{}-{}-{}-{}'.format(species, weight, u, y), rng.uniform(4, 36),
+                             rng.uniform(0.01, 1) * (3 if u == 'high-u' else 1), rng.uniform(30, 45) + (20 if y == 'high-y' else 0),
+                             rng.uniform(20, 60), rng.uniform(10, 40), rng.uniform(0.5, 1)))
+    return rows
+
+
+def curve(rng, fps, volume=4.0):
+    """
+    One experiment's data rows: a stretched-exponential absorption of the drop, with reading noise.
+    The age column is in the units the tensiometer exports (x = age/1000/fps seconds).
+    """
+    tau = rng.uniform(2, 40)
+    beta = rng.uniform(0.5, 1)
+    duration = tau * rng.uniform(2, 5)
+    t = np.arange(int(duration * fps)) / fps
+    vol = volume * np.exp(-(t / tau)**beta) + rng.normal(0, 0.002 * volume, len(t))
+    ca = 30 * np.exp(-t / (3 * tau)) + rng.normal(0, 0.5, len(t))
+    n = len(t)
+    return np.column_stack((np.arange(n), t * 1000 * fps, ca, ca, ca, rng.normal(60, 1, n), rng.uniform(0, 0.2, n),
+                            rng.normal(1, 0.01, n), rng.normal(2, 0.01, n), vol))
+
+
+def write_experiment_file(filename, data):
+    """
+    Write data rows in the tab-separated format of the tensiometer export, for the importer.
+    """
+    with open(filename, 'w') as f:
+        f.write(HEADER)
+        for row in data:
+            f.write('{:d}\t'.format(int(row[0])) + '\t'.join('{:.6g}'.format(v) for v in row[1:]) + '\n')
+
+
+def create_database(database_file, n_experiments, fps=100, seed=0, with_data=True):
+    """
+    Create a database with the binder design and n_experiments experiments spread over the binders.
+    With with_data=False only the binders are created (e.g. to benchmark importing).
+    """
+    rng = np.random.default_rng(seed)
+    conn = sqlite3.connect(database_file)
+    conn.executescript(SCHEMA)
+    binders = binder_rows(rng)
+    conn.executemany('INSERT INTO binders VALUES (?, ?, ?, ?, ?, ?, ?, ?);', binders)
+    if with_data:
+        for i in range(n_experiments):
+            binder = binders[i % len(binders)][0]
+            c = conn.execute('INSERT INTO tensiometer_experiments (binder, date, volume, fps, temperature) VALUES (?, ?, ?, ?, ?);',
+                             (binder, '2021-06-01', 4.0, fps, 22.0))
+            data = curve(rng, fps)
+            conn.executemany('INSERT INTO tensiometer_data VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?);',
+                             ((c.lastrowid, int(r[0])) + tuple(float(v) for v in r[1:]) for r in data))
+    conn.commit()
+    return conn
+
+
+def main():
+    args = sys.argv
+    if len(args) < 3:
+        print('usage: synthetic_db.py /path/to/new.db n_experiments [fps] [seed]')
+        sys.exit(1)
+    if os.path.exists(args[1]):
+        print('Database file already exists.')
+        sys.exit(1)
+    fps = float(args[3]) if len(args) > 3 else 100
+    seed = int(args[4]) if len(args) > 4 else 0
+    create_database(args[1], int(args[2]), fps, seed).close()
+
+
+# Main body
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+#!/usr/local/bin/python3.7
+"""
+Watch an inbox directory for new tensiometer exports and keep the results up to date: every file with
+sidecar metadata (experiment.txt + experiment.json) is imported once it has stopped changing, the
+absorbance time of each new experiment is calculated and cached, its rows are appended to the results
+file, and the figures whose inputs changed are re-rendered.
+
+Files are recognized by their content hash, so restarting the watcher or leaving imported files in the
+inbox doesn't import anything twice.
+"""
+
+import sys
+import os
+import time
+import argparse
+
+import importer
+import calc_absorbance
+import absorbance_cache
+import filters
+import profiling
+from db import connect
+
+
+def snapshot(inbox):
+    """
+    {path: (size, mtime_ns)} of the experiment files in the inbox.
+    """
+    files = {}
+    for name in os.listdir(inbox):
+        path = os.path.join(inbox, name)
+        if name.endswith('.txt'):
+            try:
+                st = os.stat(path)
+            except FileNotFoundError: # removed since listdir
+                continue
+            files[path] = (st.st_size, st.st_mtime_ns)
+    return files
+
+
+def ready_entries(current, previous, done):
+    """
+    The import entries for files that haven't changed since the previous poll (so they're fully written),
+    that have readable sidecar metadata, and that weren't handled already in the same state.
+    """
+    entries = []
+    for path, state in sorted(current.items()):
+        if done.get(path) == state or previous.get(path) != state:
+            continue
+        try:
+            entry = importer.read_sidecar(path)
+        except (ValueError, KeyError): # sidecar still being written
+            continue
+        if entry is not None:
+            entries.append(entry)
+    return entries
+
+
+def update_results(conn, tens_exp_ids, percent_absorbed, results_file):
+    """
+    Calculate and cache the absorbance time of the given (new) experiments, and append the rows of the
+    ones the default selection includes to the results file. Returns the rows.
+    """
+    fingerprints = absorbance_cache.fingerprints(conn, tens_exp_ids)
+    experiments = {e.experiment['tens_exp_id']: e for e in calc_absorbance.lazy_experiments(tens_exp_ids, conn)}
+    entries = []
+    times = {}
+    for tens_exp_id, e in experiments.items():
+        times[tens_exp_id] = e.calc_absorbance_time(percent_absorbed)
+        e.release_curve()
+        entries.append((tens_exp_id, fingerprints[tens_exp_id], times[tens_exp_id], e.extrapolated))
+    absorbance_cache.store(conn, percent_absorbed, entries)
+
+    rows = [calc_absorbance.result_row(row, times[row[0]]) for row in filters.NEW_DATA.only(tens_exp_ids).select(conn)
+            if row[0] in times and times[row[0]] != 0]
+    if results_file and rows:
+        new_file = not os.path.exists(results_file)
+        with open(results_file, 'a') as f:
+            if new_file:
+                print(calc_absorbance.RESULT_HEADER, file=f)
+            for r in rows:
+                print(' '.join([str(e) for e in r]), file=f)
+    return rows
+
+
+def update_figures(conn, database_file, outdir, workers):
+    """
+    Re-render the figures whose inputs changed (see plot.render_all). The absorbance times come from the
+    cache, so only the experiments imported since the last pass are calculated. plot is only imported the
+    first time, since matplotlib is slow to load.
+    """
+    import plot
+    plot.show_figures = False
+    plot.plt.switch_backend('Agg')
+    experiments = plot.load_data(database_file, conn=conn, store=True)
+    plot.render_all(experiments, plot.figure_jobs(), outdir, workers)
+
+
+def poll(conn, args, previous, done):
+    """
+    One pass over the inbox. Returns the snapshot for the next pass.
+    """
+    current = snapshot(args.inbox)
+    entries = ready_entries(current, previous, done)
+    if not entries:
+        return current
+
+    started = time.perf_counter()
+    with profiling.stage('import'):
+        imported = importer.import_batch(conn, entries, args.jobs)
+    for entry in entries:
+        done[entry[0]] = current[entry[0]]
+    if imported:
+        with profiling.stage('absorbance'):
+            rows = update_results(conn, imported, args.percent_absorbed, args.results)
+        print("Imported {} experiment(s), {} new result row(s)".format(len(imported), len(rows)), file=sys.stderr)
+        if args.outdir:
+            with profiling.stage('render'):
+                update_figures(conn, args.database_file, args.outdir, args.jobs)
+        print("Up to date after {:.1f} s".format(time.perf_counter() - started), file=sys.stderr)
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('database_file', metavar='/path/to/data.db')
+    parser.add_argument('inbox', metavar='/path/to/inbox', help='directory the tensiometer exports (with their .json sidecars) are saved to')
+    parser.add_argument('--percent-absorbed', type=float, default=79, help='absorbed percentage for the results (default: 79)')
+    parser.add_argument('--results', metavar='FILE', help='append the result rows of new experiments to this file')
+    parser.add_argument('--outdir', help='keep the figures in this directory up to date (default: no figures)')
+    parser.add_argument('--interval', type=float, default=2, help='seconds between polls of the inbox; a file is imported once it is unchanged over one interval')
+    parser.add_argument('--jobs', type=int, default=None, help='number of worker processes for importing and rendering')
+    parser.add_argument('--once', action='store_true', help='import whatever is ready and exit, instead of watching')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    profiling.from_args(args)
+
+    if not os.path.exists(args.database_file) or not os.path.isdir(args.inbox):
+        print('Database file or inbox directory could not be found.')
+        sys.exit(1)
+    conn = connect(args.database_file)
+    absorbance_cache.ensure_cache(conn)
+
+    done = {}
+    if args.once:
+        # files are taken as they are, without waiting for them to settle
+        current = snapshot(args.inbox)
+        poll(conn, args, current, done)
+        profiling.finish(args)
+        return
+
+    previous = {}
+    print("Watching {} (Ctrl-C to stop)".format(args.inbox), file=sys.stderr)
+    try:
+        while True:
+            previous = poll(conn, args, previous, done)
+            time.sleep(args.interval)
+    except KeyboardInterrupt:
+        pass
+    profiling.finish(args)
+
+
+# Main body
+if __name__ == '__main__':
+    main()